@@ -0,0 +1,67 @@
+import os
+import sys
+import cv2
+import time
+
+import numpy as np
+import random as rd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import line_detection as ld
+
+
+# ---------------------------------------------------------------------------------
+# synthetic page of 20 text rows, words are filled ellipses with dots above some of them, plus scattered noise
+def random_page(seed=0):
+    rng = rd.Random(seed)
+    image = np.zeros((1400, 1000), np.uint8)
+    for row in range(20):
+        y = 40 + row * 65
+        x = 20
+        while x < 940:
+            width = rng.randint(8, 40)
+            cv2.ellipse(image, (x + width // 2, y), (width // 2, rng.randint(6, 14)), rng.randint(-20, 20), 0, 360,
+                        1, -1)
+            if rng.random() < 0.4:
+                cv2.circle(image, (x + rng.randint(0, width), y - rng.randint(18, 24)), rng.randint(1, 3), 1, -1)
+            x += width + rng.randint(2, 10)
+    for _ in range(600):
+        cv2.circle(image, (rng.randint(0, 999), rng.randint(0, 1399)), rng.randint(0, 2), 1, -1)
+    return image
+
+
+# ---------------------------------------------------------------------------------
+# labels of the components pre_process removes as small artifacts, the decision of its cluster_elements
+def removed_components(stats, engine):
+    n_clusters = 11
+    data = stats[:, 5]
+    labels = ld.cluster_values(data, n_clusters, engine)
+    cluster_size = list(np.bincount(labels, minlength=n_clusters))
+    cluster_total = np.bincount(labels, weights=data, minlength=n_clusters)
+    minimum_cluster = np.argmin([c[1] / c[0] if c[0] > 0 else 9999 for c in zip(cluster_size, cluster_total)])
+    if cluster_size.count(minimum_cluster) / sum(cluster_size) >= 0.15:
+        return frozenset()
+    return frozenset(np.flatnonzero(labels == minimum_cluster).tolist())
+
+
+# ---------------------------------------------------------------------------------
+# times both engines on the component areas of each page, gmm is unseeded so it is run gmm_runs times
+# prints how many components each engine removes and how many gmm runs remove the same set as the exact engine
+def run(n_pages, gmm_runs=5):
+    for seed in range(n_pages):
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats(random_page(seed), connectivity=8,
+                                                                  ltype=cv2.CV_32S)
+        stats = np.asarray([np.append(stat[0], stat[1]) for stat in zip(range(num_labels), stats)])
+        start = time.perf_counter()
+        exact = removed_components(stats, 'exact')
+        exact_time = time.perf_counter() - start
+        start = time.perf_counter()
+        gmms = [removed_components(stats, 'gmm') for _ in range(gmm_runs)]
+        gmm_time = (time.perf_counter() - start) / gmm_runs
+        print('page %d, %d components: exact %.1fms removes %d, gmm %.1fms removes %s, same as exact %d/%d' %
+              (seed, num_labels, exact_time * 1000, len(exact), gmm_time * 1000, [len(gmm) for gmm in gmms],
+               sum(gmm == exact for gmm in gmms), gmm_runs))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
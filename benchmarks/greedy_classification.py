@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+
+import numpy as np
+import random as rd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import line_detection as ld
+
+
+# ---------------------------------------------------------------------------------
+# random document graph and junction scores, junctions are (u, v, w1, w2) with three scored edges each
+def random_junctions(n_junctions, seed=0):
+    rng = rd.Random(seed)
+    graph = ld.DocumentGraph()
+    vertexes = [(rng.randrange(200), rng.randrange(200)) for _ in range(n_junctions // 2 + 10)]
+    while len(graph) < max(n_junctions // 4, 20):
+        u, v = rng.sample(vertexes, 2)
+        if (u, v) not in graph:
+            graph[(u, v)] = [u, v]
+    edges = list(graph.keys())
+    t_scores = dict()
+    for index in range(n_junctions):
+        e_1, e_2, e_3 = rng.sample(edges, 3)
+        t_scores[(index, 0, 0, 0)] = [(e_1[0], e_1[1], round(rng.random(), 3)), (e_2[1], e_2[0], rng.random()),
+                                      (e_3[0], e_3[1], rng.random())]
+    return t_scores, graph
+
+
+# ---------------------------------------------------------------------------------
+# greedy labelling as it was before the priority queue - the minimal junction is found by a scan of all
+# remaining junctions on every pop
+def scan_classification(t_scores, edge_dictionary):
+    bridges = set()
+    links = set()
+    while t_scores:
+        min_score_key = list(t_scores.keys())[np.argmin([value[0][2] for value in t_scores.values()])]
+        min_score = t_scores[min_score_key][0]
+        new_bridge = edge_dictionary.key(min_score[0], min_score[1])
+        if new_bridge not in links:
+            bridges.add(new_bridge)
+            for e_1, e_2, _ in t_scores[min_score_key][1:]:
+                links.add(edge_dictionary.key(e_1, e_2))
+        t_scores.pop(min_score_key)
+    anchors = [x for x in edge_dictionary.keys() if x not in bridges and x not in links]
+    anchor_coords = set(coord for edge in anchors for coord in edge)
+    for bridge in bridges:
+        if bridge[0] in anchor_coords or bridge[1] in anchor_coords:
+            links.add(bridge)
+    return bridges, links, anchors
+
+
+# ---------------------------------------------------------------------------------
+# times greedy_classification against the scan for each junction count, scans only up to max_scan junctions
+def run(junction_counts, max_scan=5000):
+    ld.artifact_writer.set_level('none')
+    ld.time_print = lambda msg: None
+    skeleton = np.zeros((200, 200), np.uint8)
+    for n_junctions in junction_counts:
+        t_scores, graph = random_junctions(n_junctions)
+        start = time.perf_counter()
+        bridges, links, anchors, _ = ld.greedy_classification(dict(t_scores), graph, skeleton, '', 'v_scores', None)
+        heap_time = time.perf_counter() - start
+        line = '%6d junctions: heap %.3fs' % (n_junctions, heap_time)
+        if n_junctions <= max_scan:
+            start = time.perf_counter()
+            expected = scan_classification(dict(t_scores), graph)
+            scan_time = time.perf_counter() - start
+            line += ', scan %.3fs, same labels: %s' % (scan_time, expected == (bridges, links, anchors))
+        print(line)
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [500, 2000, 5000, 20000])
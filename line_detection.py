@@ -2,114 +2,88 @@ import os
 import cv2
 import math
 import copy
-import pylab
+import heapq
 import shutil
 import datetime
+import threading
+import multiprocessing
 
 import numpy as np
 import random as rd
 import operator as op
-import functools as ft
 import itertools as it
 import collections as col
 
 from skan import csr
 from os import listdir
+from skimage import draw
+from scipy import special
 from scipy import optimize
 
 from skimage import morphology
 from os.path import isfile, join
-from scipy import integrate as intg
-from matplotlib import pyplot as plt
-from decimal import Decimal, getcontext
+from scipy.spatial import cKDTree
 
 from concurrent import futures
+from collections.abc import MutableMapping
 from sklearn.mixture import GaussianMixture
 from concurrent.futures import ProcessPoolExecutor
 
+# numba is optional, calculate_local_maxima_mask falls back to numpy without it
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 # ---
 # Find the intercepts of two curves, given by the same x data
 def interpolated_intercepts(x, y1, y2):
-    def intercept(point1, point2, point3, point4):
-        """find the intersection between two lines
-        the first line is defined by the line between point1 and point2
-        the first line is defined by the line between point3 and point4
-        each point is an (x,y) tuple.
-
-        So, for example, you can find the intersection between
-        intercept((0,0), (1,1), (0,1), (1,0)) = (0.5, 0.5)
-
-        Returns: the intercept, in (x,y) format
-        """
-
-        def line(p1, p2):
-            A = (p1[1] - p2[1])
-            B = (p2[0] - p1[0])
-            C = (p1[0]*p2[1] - p2[0]*p1[1])
-            return A, B, -C
-
-        def intersection(L1, L2):
-            D  = L1[0] * L2[1] - L1[1] * L2[0]
-            Dx = L1[2] * L2[1] - L1[1] * L2[2]
-            Dy = L1[0] * L2[2] - L1[2] * L2[0]
-
-            x = Dx / D
-            y = Dy / D
-            return x,y
-
-        L1 = line([point1[0],point1[1]], [point2[0],point2[1]])
-        L2 = line([point3[0],point3[1]], [point4[0],point4[1]])
-
-        R = intersection(L1, L2)
-
-        return R
-
-    idxs = np.argwhere(np.diff(np.sign(y1 - y2)) != 0)
-
-    xcs = []
-    ycs = []
-
-    for idx in idxs:
-        xc, yc = intercept((x[idx], y1[idx]),((x[idx+1], y1[idx+1])), ((x[idx], y2[idx])), ((x[idx+1], y2[idx+1])))
-        xcs.append(xc)
-        ycs.append(yc)
-    return np.array(xcs), np.array(ycs)
+    # the two curves cross in every cell [x[i], x[i + 1]] where the sign of y1 - y2 changes,
+    # the intercept is the intersection of the lines through the cell end points of each curve
+    idxs = np.flatnonzero(np.diff(np.sign(y1 - y2)) != 0)
+    x_1, x_2 = x[idxs], x[idxs + 1]
+    a_1, b_1, c_1 = y1[idxs] - y1[idxs + 1], x_2 - x_1, -(x_1 * y1[idxs + 1] - x_2 * y1[idxs])
+    a_2, b_2, c_2 = y2[idxs] - y2[idxs + 1], x_2 - x_1, -(x_1 * y2[idxs + 1] - x_2 * y2[idxs])
+    d = a_1 * b_2 - b_1 * a_2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xcs = (c_1 * b_2 - b_1 * c_2) / d
+        ycs = (a_1 * c_2 - c_1 * a_2) / d
+    return xcs, ycs
 
 
 # ---------------------------------------------------------------------------------
 # draw_edges(edges, edge_dictionary, image, color):
 def draw_edges(edges, edge_dictionary, image, color, image_offset_values=None):
-    for edge in edges:
-        if edge not in edge_dictionary.keys():
-            continue
-        edge_list = edge_dictionary[edge]
-        if image_offset_values is not None:
-            offset_edge_list = [(e[0]+image_offset_values[0], e[1]+image_offset_values[1]) for e
-                                in edge_list]
-        else:
-            offset_edge_list = edge_list
-        image = overlay_edges(image, offset_edge_list, color)
-    return image
+    edge_lists = [edge_dictionary[edge] for edge in edges if edge in edge_dictionary]
+    return render_edges(image, edge_lists, color, image_offset_values)
 
 
 # ---------------------------------------------------------------------------------
-# auxiliary function to overlay edges on original image
-def overlay_edges(image, edge_list, color=None):
-    image_copy = copy.deepcopy(image)
-
-    # random_color = (100, 156, 88)
-    if color is None:
-        random_color = (rd.randint(50, 255), rd.randint(50, 255), rd.randint(50, 255))
-    else:
-        random_color = color
-    for point in edge_list:
-        r, g, b = image_copy[point]
-        if r == 0 and g == 0 and b == 0:
-            image_copy[point] = random_color
-        else:
-            image_copy[point] = (0, 255, 255)
-    return image_copy
+# draws edges into image in place, colors is one color for all edges or a color for each edge
+# edges are drawn into one label image, and their colors are taken from a color lookup table
+# a pixel drawn once on a black pixel gets the color of its edge, pixels drawn more than once
+# or drawn on a colored pixel are marked yellow (0, 255, 255)
+def render_edges(image, edge_lists, colors, image_offset_values=None):
+    if not edge_lists:
+        return image
+    pixels = np.concatenate([np.asarray(edge_list).reshape(-1, 2) for edge_list in edge_lists]).astype(np.int64)
+    if image_offset_values is not None:
+        pixels += np.asarray(image_offset_values, np.int64)
+    flat_pixels = np.ravel_multi_index((pixels[:, 0], pixels[:, 1]), image.shape[:2])
+
+    labels = np.full(image.shape[:2], -1, np.int32)
+    labels.flat[flat_pixels] = np.repeat(np.arange(len(edge_lists), dtype=np.int32),
+                                         [len(edge_list) for edge_list in edge_lists])
+    color_lut = np.broadcast_to(np.asarray(colors, image.dtype).reshape(-1, 3), (len(edge_lists), 3))
+
+    times_drawn = np.bincount(flat_pixels)
+    drawn = np.flatnonzero(times_drawn)
+    rows, cols = np.unravel_index(drawn, image.shape[:2])
+    colored = (times_drawn[drawn] == 1) & ~np.any(image[rows, cols] != 0, axis=1)
+    image[rows[colored], cols[colored]] = color_lut[labels[rows[colored], cols[colored]]]
+    image[rows[~colored], cols[~colored]] = (0, 255, 255)
+    return image
 
 
 # ---------------------------------------------------------------------------------
@@ -124,32 +98,25 @@ def get_spaced_colors(n):
 
 # ---------------------------------------------------------------------------------
 # draw_graph_edges
-def draw_graph_edges(edge_dictionary, ridges_mask, window_name, wait_flag=False, overlay=False, image_offset_values=None, file_name=None):
+def draw_graph_edges(edge_dictionary, ridges_mask, window_name, wait_flag=False, overlay=False, image_offset_values=None, file_name=None, level='stages'):
+    name = './' + window_name + '/' + file_name + '.png'
+    if not wait_flag and not artifact_writer.writes(level):
+        return name
+
     if overlay:
-        after_ridge_mask = ridges_mask
+        after_ridge_mask = copy.deepcopy(ridges_mask)
     else:
         after_ridge_mask = cv2.cvtColor(np.zeros_like(ridges_mask), cv2.COLOR_GRAY2RGB)
 
-    i = 0
-    for edge_list in edge_dictionary.values():
+    after_ridge_mask = render_edges(after_ridge_mask, list(edge_dictionary.values()), (57, 255, 20),
+                                    image_offset_values)
+    if len(edge_dictionary):
+        vertexes = np.asarray(list(edge_dictionary.keys())).reshape(-1, 2)
         if image_offset_values is not None:
-            offset_edge_list = [(e[0]+image_offset_values[0], e[1]+image_offset_values[1]) for e
-                                in edge_list]
-        else:
-            offset_edge_list = edge_list
-        after_ridge_mask = overlay_edges(after_ridge_mask, offset_edge_list, (57, 255, 20))
-        i += 1
-    for two_vertex in edge_dictionary.keys():
-        v1, v2 = two_vertex
-        if image_offset_values is not None:
-            v1 = (v1[0] + image_offset_values[0], v1[1] + image_offset_values[1])
-            v2 = (v2[0] + image_offset_values[0], v2[1] + image_offset_values[1])
-        after_ridge_mask[v1] = (255, 255, 255)
-        after_ridge_mask[v2] = (255, 255, 255)
+            vertexes = vertexes + np.asarray(image_offset_values)
+        after_ridge_mask[vertexes[:, 0], vertexes[:, 1]] = (255, 255, 255)
 
-    name = './' + window_name + '/' + file_name + '.png'
-    cv2.imwrite(name, after_ridge_mask)
-    cv2.imwrite('./' + window_name + '/' + file_name + '_inverted.png', 255 - after_ridge_mask)
+    artifact_writer.write(name, after_ridge_mask, level, inverted=True)
     if wait_flag:
         cv2.namedWindow(window_name)
         cv2.imshow(window_name, after_ridge_mask)
@@ -159,6 +126,123 @@ def draw_graph_edges(edge_dictionary, ridges_mask, window_name, wait_flag=False,
     return name
 
 
+# ---------------------------------------------------------------------------------
+# exact 1-d clustering - optimal 1-d k-means (minimum within cluster sum of squares) by dynamic programming
+# over the sorted unique values weighted by their counts. the best start of the last cluster is monotone in
+# the number of values, so each layer is solved by bisection over the rows, one level of rows at a time
+# returns the cluster of each value, clusters are numbered by increasing value
+def cluster_1d_exact(values, n_clusters):
+    values = np.asarray(values, np.float64).ravel()
+    unique_values, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    n = len(unique_values)
+    n_clusters = min(n_clusters, n)
+    # centered values keep the prefix sums small
+    x = unique_values - np.average(unique_values, weights=counts)
+    weight_sum = np.concatenate(([0.0], np.cumsum(counts)))
+    x_sum = np.concatenate(([0.0], np.cumsum(counts * x)))
+    xx_sum = np.concatenate(([0.0], np.cumsum(counts * x * x)))
+
+    # sum of squares of the unique values starts..ends as a single cluster
+    def cluster_cost(starts, ends):
+        weights = weight_sum[ends + 1] - weight_sum[starts]
+        totals = x_sum[ends + 1] - x_sum[starts]
+        return np.maximum(xx_sum[ends + 1] - xx_sum[starts] - totals * totals / weights, 0)
+
+    # cost[k][i] - minimal cost of values 0..i in k + 1 clusters, first[k][i] - first value of the last cluster
+    cost = np.full((n_clusters, n), np.inf)
+    first = np.zeros((n_clusters, n), np.int64)
+    cost[0] = cluster_cost(np.zeros(n, np.int64), np.arange(n))
+    for k in range(1, n_clusters):
+        # pending row ranges lows..highs whose best starts lie in start_lows..start_highs
+        lows, highs = np.asarray([k]), np.asarray([n - 1])
+        start_lows, start_highs = np.asarray([k]), np.asarray([n - 1])
+        while len(lows):
+            rows = (lows + highs) // 2
+            lengths = np.minimum(rows, start_highs) - start_lows + 1
+            offsets = np.cumsum(lengths) - lengths
+            segment = np.repeat(np.arange(len(rows)), lengths)
+            starts = start_lows[segment] + np.arange(len(segment)) - offsets[segment]
+            candidates = cost[k - 1, starts - 1] + cluster_cost(starts, rows[segment])
+            best = np.minimum.reduceat(candidates, offsets)
+            # first start reaching the minimum of each row
+            hits = np.flatnonzero(candidates == best[segment])
+            hits = hits[np.diff(segment[hits], prepend=-1) != 0]
+            best_starts = starts[hits]
+            cost[k, rows] = best
+            first[k, rows] = best_starts
+            left, right = rows > lows, rows < highs
+            lows, highs, start_lows, start_highs = \
+                np.concatenate((lows[left], rows[right] + 1)), np.concatenate((rows[left] - 1, highs[right])), \
+                np.concatenate((start_lows[left], best_starts[right])), \
+                np.concatenate((best_starts[left], start_highs[right]))
+
+    unique_labels = np.zeros(n, np.int64)
+    end = n - 1
+    for k in range(n_clusters - 1, 0, -1):
+        start = first[k, end]
+        unique_labels[start: end + 1] = k
+        end = start - 1
+    return unique_labels[inverse]
+
+
+# ---------------------------------------------------------------------------------
+# cluster 1-d values, engine is 'gmm' (gaussian mixture) or 'exact' (cluster_1d_exact)
+# returns the cluster of each value
+def cluster_values(values, n_clusters, engine='gmm'):
+    if engine == 'gmm':
+        data = np.asarray(values).reshape(-1, 1)
+        gmm = GaussianMixture(n_components=n_clusters)
+        gmm.fit(data)
+        return gmm.predict(data)
+    if engine == 'exact':
+        return cluster_1d_exact(values, n_clusters)
+    raise ValueError('unknown clustering engine: ' + str(engine))
+
+
+# ---------------------------------------------------------------------------------
+# gaussian with mean mu, standard deviation sigma and height A
+def gauss(x_value, mu, sigma, A):
+    return A * np.exp(-(x_value - mu) ** 2 / 2 / sigma ** 2)
+
+
+# ---------------------------------------------------------------------------------
+# integral of gauss over [low, high]
+def gauss_mass(mu, sigma, A, low, high):
+    scale = np.sqrt(2) * np.abs(sigma)
+    return A * np.abs(sigma) * np.sqrt(np.pi / 2) * (special.erf((high - mu) / scale) -
+                                                      special.erf((low - mu) / scale))
+
+
+# ---------------------------------------------------------------------------------
+# fits n gaussians to n equal pieces of hist, returns the fitted (mu, sigma, A) of each gaussian,
+# mu shifted to hist coordinates, and the mass of each gaussian outside its piece as the fit error
+# module level so split_touching_lines can hand the fits to a process pool
+def get_n_cut_valleys(hist, n):
+    # n gaussians fitting attempt
+    try:
+        piece = math.floor(len(hist) / n)
+        y_n = [hist[i_dx * piece: (i_dx + 1) * piece] for i_dx in range(0, n)]
+        x_n = [np.arange(len(y_i)) for y_i in y_n]
+        params_n = np.asarray([optimize.curve_fit(gauss, x_i, y_i, method='trf')[0]
+                               for x_i, y_i in zip(x_n, y_n)])
+
+    except RuntimeError:
+        print('could not fit')
+        return None, np.full(n, np.inf)
+    except ValueError:
+        return None, np.full(n, np.inf)
+
+    # append shift for mu_i
+    shift = math.floor((len(hist) + 1) / n)
+    params_n[:, 0] += np.arange(n) * shift
+    mu_n, sigma_n, A_n = params_n.T
+    # mass of each gaussian outside [0, len(y_i)], in closed form
+    lengths = np.asarray([len(y_i) for y_i in y_n])
+    good_n = np.abs(gauss_mass(mu_n, sigma_n, A_n, 0, lengths) - gauss_mass(mu_n, sigma_n, A_n, -np.inf, np.inf))
+    print('good_n=', list(good_n))
+    return params_n, good_n
+
+
 # ---------------------------------------------------------------------------------
 # split touching lines. find mean line width in image
 # find connected components
@@ -167,102 +251,31 @@ def draw_graph_edges(edge_dictionary, ridges_mask, window_name, wait_flag=False,
 # find cluster with highest width average
 # for each connected component create histogram. each bin is row value count number of pixels
 # find three adjacent bins with min average of all, and remove them from image
-def split_touching_lines(image, average_width=None):
-    def calc_valleys(gauss_n, hist):
-        x_s = np.asarray([z for z in range(len(hist))])
+def split_touching_lines(image, average_width=None, clustering='gmm', executor=None):
+    def calc_valleys(params_n, hist):
+        x_s = np.arange(len(hist))
         result = list()
-        # print('gauss_n=', gauss_n)
-        for i_dx in range(0, len(gauss_n) - 1):
-            gauss_1 = gauss_n[i_dx]
-            gauss_2 = gauss_n[i_dx + 1]
-            x_s_i, _ = interpolated_intercepts(x_s, np.asarray([gauss_1(r) for r in x_s]),
-                                               np.asarray([gauss_2(r) for r in x_s]))
-            for elem1 in x_s_i:
-                result.append(np.int32(elem1))
+        # print('params_n=', params_n)
+        for params_1, params_2 in zip(params_n[:-1], params_n[1:]):
+            x_s_i, _ = interpolated_intercepts(x_s, gauss(x_s, *params_1), gauss(x_s, *params_2))
+            result.extend(x_s_i.astype(np.int32))
         return result
 
-    def get_n_cut_valleys(hist, n):
-        plt.clf()
-        plt.plot(histogram, color='black', label='hist')
-        plt.xlim([0, len(hist)])
-        x_s = np.asarray([z for z in range(len(hist))])
-
-        # n gaussians fitting attempt
-        try:
-            piece = math.floor(len(hist) / n)
-            y_n = [hist[i_dx * piece: (i_dx + 1) * piece] for i_dx in range(0, n)]
-            x_n = [np.asarray([z for z in range(len(y_n[y_i_dx]))]) for y_i_dx in range(0, len(y_n))]
-            params_n = [optimize.curve_fit(gauss, x_i, y_i, method='trf')[0] for x_i, y_i in zip(x_n, y_n)]
-
-        except RuntimeError:
-            print('could not fit')
-            plt.clf()
-            return [None for l in range(n)], [np.inf for l in range(n)]
-        except ValueError:
-            plt.clf()
-            return [None for l in range(n)], [np.inf for l in range(n)]
-
-        # append shift for mu_i
-        mu_n = [params_i[0] for params_i in params_n]
-        sigma_n = [params_i[1] for params_i in params_n]
-        A_n = [params_i[2] for params_i in params_n]
-        shift = math.floor((len(hist) + 1) / n)
-
-        mu_n = [mu_i + i_dx * shift for i_dx, mu_i in enumerate(mu_n)]
-        gauss_n = [ft.partial(gauss, mu=mu_i, sigma=sigma_i, A=A_i) for mu_i, sigma_i, A_i in
-                   zip(mu_n, sigma_n, A_n)]
-        y_n_values = [hist[i_dx * piece: (i_dx + 1) * piece] for i_dx in range(0, n)]
-        gauss_y_n = list()
-        for gauss_i, y_i in zip(gauss_n, y_n_values):
-            gauss_y_n.append([gauss_i(y_i_i) for y_i_i in range(0, len(y_i))])
-        good_n = [np.abs(intg.quad(gauss_i, 0, len(y_n_values[hist_idx]), args=())[0] -
-                         intg.quad(gauss_i, -np.inf, np.inf, args=())[0])
-                  for hist_idx, gauss_i in enumerate(gauss_n)]
-        print('good_n=', good_n)
-
-        colors=['green', 'blue', 'red', 'yellow', 'magenta', 'brown', 'teal', 'purple', 'cyan', 'coral', 'olive', 'maroon']
-        for indx, gauss_i in enumerate(gauss_n):
-            plt.plot(x_s, gauss_i(x_s), color=colors[indx], lw=3, label='gauss_' + str(indx))
-        plt.legend()
-        plt.show()
-        plt.clf()
-        return gauss_n, good_n
-
-    def gauss(x_value, mu, sigma, A):
-        return A * pylab.exp(-(x_value - mu) ** 2 / 2 / sigma ** 2)
-
-    def draw_component_on_image(label_i, all_labels, overlay_image, color):
-        for index in zip(*np.where(all_labels == label_i)):
-            overlay_image[index] = color
-
     def draw_component(pixels_list, draw_on_image):
         for p in pixels_list:
             draw_on_image[p] = (255, 0, 0)
 
     def cluster_elements(heights_to_cluster, average_width=None):
         n_clusters = 3
-        heights_to_cluster = np.asarray(heights_to_cluster).reshape(-1, 1)
-        gmm = GaussianMixture(n_components=n_clusters)
-        gmm.fit(heights_to_cluster)
-        y_k_means = gmm.predict(heights_to_cluster)
-        clustered_heights = [[] for k in range(n_clusters)]
-
-        for k in range(n_clusters):
-            ix = 0
-            for y_k in y_k_means:
-                if y_k == k:
-                    clustered_heights[k].append(heights_to_cluster[ix][0])
-                ix += 1
-        clusters = [list(filter(lambda x_0: x_0 == k, y_k_means)) for k in range(n_clusters)]
-        cluster_size = [len(cluster) for cluster in clusters]
+        heights_to_cluster = np.asarray(heights_to_cluster, np.float64)
+        y_k_means = cluster_values(heights_to_cluster, n_clusters, clustering)
+        cluster_size = np.bincount(y_k_means, minlength=n_clusters)
         # print('cluster_size=', cluster_size)
-        cluster_total_widths = [sum(heights_to_cluster[l[0]] for l in enumerate(y_k_means) if l[1] == k) for k in
-                                 range(n_clusters)]
-        cluster_average_sizes = [pair[0] / pair[1] if pair[1] != 0 else 0 for pair in zip(cluster_total_widths, cluster_size)]
-        cluster_total = [ft.reduce(lambda x_1, y_1: x_1 + y_1[1] if y_1[0] == k else x_1,
-                                   zip(list(y_k_means), heights_to_cluster), 0) for k in range(n_clusters)]
-        max_cluster = np.argmax([c[1]/c[0] for c in zip(cluster_size, cluster_total)])
-        ratios = [(cluster_average_sizes[z] / cluster_average_sizes[max_cluster])[0] for z in range(n_clusters)]
+        cluster_total = np.bincount(y_k_means, weights=heights_to_cluster, minlength=n_clusters)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cluster_average_sizes = np.where(cluster_size != 0, cluster_total / cluster_size, 0)
+            max_cluster = np.argmax(cluster_total / cluster_size)
+            ratios = cluster_average_sizes / cluster_average_sizes[max_cluster]
         max_average = cluster_average_sizes[np.argmax(ratios)]
         first_cluster = ratios[np.argmax(ratios)]
         ratios[np.argmax(ratios)] = -1
@@ -284,118 +297,98 @@ def split_touching_lines(image, average_width=None):
     if max_cluster_index is None:
         return image, None, None, 0, None
 
-    to_view = cv2.cvtColor(np.zeros_like(labels, np.uint8), cv2.COLOR_GRAY2RGB)
-    i = 1
-    for component in clustered:
-        if component == 0:
-            draw_component_on_image(i, labels, to_view, (0, 0, 255))
-        elif component == 1:
-            draw_component_on_image(i, labels, to_view, (0, 255, 0))
-        elif component == 2:
-            draw_component_on_image(i, labels, to_view, (255, 0, 0))
-        i += 1
+    # colour every component by its cluster in a single lookup, background stays black
+    colors = np.asarray([(0, 0, 255), (0, 255, 0), (255, 0, 0)], np.uint8)
+    color_lut = np.zeros((num_labels, 3), np.uint8)
+    color_lut[1:] = colors[clustered]
+    to_view = color_lut[labels]
     before_splitting = copy.deepcopy(to_view)
-    i = 0
+    # fit the components of the max cluster first, with an executor the fits run there and are read back
+    # in submission order, only the histograms are sent
+    fits = list()
+    for i in np.flatnonzero(clustered == max_cluster_index) + 1:
+        x, y, w, h = stats[i, :4]
+        # print('old_width=', old_width, 'component_width=', h)
+        if old_width is not None and old_width > h:
+            continue
+        # work inside the bounding box of the component only
+        component_mask = labels[y: y + h, x: x + w] == i
+        # create histogram then split !
+        # pixels are in row order, the columns of row r are row_xs[row_starts[r]: row_starts[r + 1]]
+        component_ys, row_xs = np.nonzero(component_mask)
+        histogram = np.bincount(component_ys, minlength=h)
+        if executor is None:
+            candidate_xs = [get_n_cut_valleys(histogram, n) for n in range(2, 10)]
+        else:
+            candidate_xs = [executor.submit(get_n_cut_valleys, histogram, n) for n in range(2, 10)]
+        fits.append((i, component_mask, row_xs, histogram, candidate_xs))
+
     total_segmented = 0
-    for component in clustered:
-        i += 1
-        component_image = np.zeros_like(image)
-        draw_component_on_image(i, labels, component_image, 255)
-        x, y, w, h, = cv2.boundingRect(component_image)
-        component_image = component_image[y: y + h, x: x + w]
-        if component == max_cluster_index:
-            component_image = np.zeros_like(image)
-            draw_component_on_image(i, labels, component_image, 255)
-            x, y, w, h, = cv2.boundingRect(component_image)
-            component_image = component_image[y: y + h, x: x + w]
-            new_image = cv2.cvtColor(np.zeros_like(component_image), cv2.COLOR_GRAY2RGB)
-            new_image[component_image == 255] = (255, 0, 0)
-            component_image = new_image
-            component_indexes = list(zip(*np.where(labels == i)))
-            # create histogram then split !
-            y_indexes = [index[0] for index in component_indexes]
-            # print('y_indexes=', y_indexes)
-            min_y = min(y_indexes)
-            max_y = max(y_indexes)
-            j = 0
-            histogram = [0 for x in range(min_y, max_y + 1)]
-            # print('old_width=', old_width, 'component_width=', len(histogram))
-            if old_width is not None and old_width > len(histogram):
-                continue
-            for y_val in range(min_y, max_y + 1):
-                histogram[j] = y_indexes.count(y_val)
-                j += 1
-
-            candidate_xs = [get_n_cut_valleys(histogram, i) for i in range(2, 10)]
-            candidates_xs = [elem[0] for elem in candidate_xs]
-            candidates_xs_errors = [elem[1] for elem in candidate_xs]
-
-            candidate_xs = list(filter(lambda elem: elem is not None, candidate_xs))
-
-            all_xs = None
-            min_average_error = np.inf
-            for candidate in candidate_xs:
-                new_error = sum(candidate[1]) / len(candidate[1])
-                if min_average_error > new_error:
-                    all_xs = candidate
-                    min_average_error = new_error
-            if min_average_error == np.inf:
-                continue
+    for i, component_mask, row_xs, histogram, candidate_xs in fits:
+        if executor is not None:
+            candidate_xs = [candidate.result() for candidate in candidate_xs]
+        if fit_diagnostics.wants(i):
+            fit_diagnostics.add(i, histogram, candidate_xs)
+        x, y, w, h = stats[i, :4]
+        component_image = np.zeros((h, w, 3), np.uint8)
+        component_image[component_mask] = (255, 0, 0)
+        row_starts = np.concatenate(([0], np.cumsum(histogram)))
+        min_y = y
+
+        all_xs = None
+        min_average_error = np.inf
+        for candidate in candidate_xs:
+            new_error = sum(candidate[1]) / len(candidate[1])
+            if min_average_error > new_error:
+                all_xs = candidate
+                min_average_error = new_error
+        if min_average_error == np.inf:
+            continue
 
-            all_xs = calc_valleys(all_xs[0], histogram)
+        all_xs = calc_valleys(all_xs[0], histogram)
 
-            total_segmented += 1
-            range_to_remove = 15
+        total_segmented += 1
+        range_to_remove = 15
 
 
-            for item in all_xs:
-                min_valley = np.int32(item[0])
-                # print(min_valley)
-                if histogram[min_valley] > np.max(histogram) * 0.5:
-                    continue
-                ranges = [range(-range_to_remove, 0), range(0, range_to_remove)]
-                for one_range in ranges:
-                    for j in one_range:
-                        y_to_remove = min_y + min_valley + j
-                        cropped_y_to_remove = min_valley + j
-                        indices_to_remove = [index for index in component_indexes if index[0] == y_to_remove]
-                        if len(indices_to_remove) == 0:
-                            continue
-                        for idx in range(component_image.shape[1]):
-                            try:
-                                if np.any(component_image[cropped_y_to_remove, idx] != 0):
-                                    component_image[cropped_y_to_remove, idx] = (255, 255, 255)
-                            except IndexError as e:
-                                print(str(e))
-                        most_left = np.min([index[1] for index in indices_to_remove])
-                        most_right = np.max([index[1] for index in indices_to_remove])
-                        if most_right - most_left > 0.6 * component_image.shape[1]\
-                                and len(indices_to_remove) > 0.6 * np.max(histogram):
-                            break
-                        for index in indices_to_remove:
-                            image[index] = 0
-                            to_view[index] = (255, 255, 255)
+        for min_valley in all_xs:
+            # print(min_valley)
+            if histogram[min_valley] > np.max(histogram) * 0.5:
+                continue
+            ranges = [range(-range_to_remove, 0), range(0, range_to_remove)]
+            for one_range in ranges:
+                for j in one_range:
+                    y_to_remove = min_y + min_valley + j
+                    cropped_y_to_remove = min_valley + j
+                    if not 0 <= cropped_y_to_remove < h or histogram[cropped_y_to_remove] == 0:
+                        continue
+                    row_image = component_image[cropped_y_to_remove]
+                    row_image[np.any(row_image != 0, axis=1)] = (255, 255, 255)
+                    row_columns = row_xs[row_starts[cropped_y_to_remove]: row_starts[cropped_y_to_remove + 1]]
+                    if row_columns[-1] - row_columns[0] > 0.6 * component_image.shape[1]\
+                            and len(row_columns) > 0.6 * np.max(histogram):
+                        break
+                    # erase the component pixels of the row inside the bounding box
+                    row_pixels = component_mask[cropped_y_to_remove]
+                    image[y_to_remove, x: x + w][row_pixels] = 0
+                    to_view[y_to_remove, x: x + w][row_pixels] = (255, 255, 255)
 
     return image, to_view, before_splitting, total_segmented, average_width
 
 
 # ---------------------------------------------------------------------------------
 # document pre processing
-def pre_process(path, file_name, str_idx=''):
+def pre_process(path, file_name, str_idx='', clustering='gmm', executor=None):
     def cluster_elements(all_stats):
         max_cluster_threshold = 0.15
         n_clusters = 11
-        data_list = [stat[5] for stat in all_stats]
-        data = np.asarray(data_list).reshape(-1, 1)
-        gmm = GaussianMixture(n_components=n_clusters)
-        gmm.fit(data)
-        y_k_gmms = gmm.predict(data)
+        data = all_stats[:, 5]
+        y_k_gmms = cluster_values(data, n_clusters, clustering)
 
-        cluster_size = [len(list(filter(lambda x0: x0 == i, y_k_gmms))) for i in range(n_clusters)]
+        cluster_size = list(np.bincount(y_k_gmms, minlength=n_clusters))
         total = sum(cluster_size)
 
-        cluster_total = [ft.reduce(lambda x, y: x + y[1] if y[0] == i else x, zip(list(y_k_gmms), data_list), 0)
-                         for i in range(n_clusters)]
+        cluster_total = np.bincount(y_k_gmms, weights=data, minlength=n_clusters)
         minimum_cluster = np.argmin([c[1]/c[0] if c[0] > 0 else 9999 for c in zip(cluster_size, cluster_total)])
         minimum_cluster_size = cluster_size.count(minimum_cluster)
         if minimum_cluster_size / total < max_cluster_threshold:
@@ -409,29 +402,22 @@ def pre_process(path, file_name, str_idx=''):
     x, y, w, h = cv2.boundingRect(image)
     image = image[y + 1: y + h - 1, x + 1: x + w - 1]
 
-    cv2.imwrite('./' + file_name + '/original_image.png', image)
-    cv2.imwrite('./' + file_name + '/original_image_inverted.png', 255 - image)
+    artifact_writer.write('./' + file_name + '/original_image.png', image, inverted=True)
     image = cv2.threshold(image, 0, 1, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
     image = 1 - image
-    cv2.imwrite('./' + file_name + '/otsu.png', image * 255)
-    cv2.imwrite('./' + file_name + '/otsu_inverted.png', 255 - image * 255)
+    artifact_writer.write('./' + file_name + '/otsu.png', image * 255, inverted=True)
     num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(image, connectivity=8, ltype=cv2.CV_32S)
     stats = np.asarray([np.append(stat[0], stat[1]) for stat in zip(range(num_labels), stats)])
 
     # removing small artifacts and diactrics, using k-means
     results, min_cluster = cluster_elements(stats)
     if min_cluster is not None:
-        index = 0
         time_print(str_idx + 'elements to be deleted: ' + str(np.count_nonzero(results == 0)))
-        for clustered in results:
-            if clustered == min_cluster:
-                # print('deleted:', index, 'size=', stats[index, 5])
-                labels[labels == index] = 0
-            index += 1
-
-        labels[labels != 0] = 1
-        image_no_tiny_elements = op.and_(image, labels.astype(np.uint8))
-        cv2.imwrite('./' + file_name + '/image_no_tiny_elements.png', image_no_tiny_elements * 255)
+        # keep lookup table over the labels, the background and the minimal cluster are dropped in one pass
+        keep = (results != min_cluster).astype(np.uint8)
+        keep[0] = 0
+        image_no_tiny_elements = op.and_(image, keep[labels])
+        artifact_writer.write('./' + file_name + '/image_no_tiny_elements.png', image_no_tiny_elements * 255)
     else:
         time_print(str_idx + 'NO ELEMENTS to be deleted: MIN CLUSTER SIZE =' + str(np.count_nonzero(results == 0)))
         image_no_tiny_elements = image
@@ -439,23 +425,25 @@ def pre_process(path, file_name, str_idx=''):
     # split touching lines
     time_print(str_idx + 'split touching lines ...')
     image_no_tiny_elements, to_view, before_splitting, total_segmented, average_width = \
-        split_touching_lines(image_no_tiny_elements)
+        split_touching_lines(image_no_tiny_elements, clustering=clustering, executor=executor)
+    fit_diagnostics.render('./' + file_name + '/touching_lines_1')
     if to_view is None:
         time_print(str_idx + 'No touching lines need to be split! 1')
     else:
         time_print(str_idx + 'LINES SPLIT DONE! REMOVED= ' + str(total_segmented))
-        cv2.imwrite('./' + file_name + '/before_remove_touching_lines_1.png', before_splitting)
-        cv2.imwrite('./' + file_name + '/after_remove_touching_lines_1.png', to_view)
-        cv2.imwrite('./' + file_name + '/removed_touching_lines_1.png', image_no_tiny_elements * 255)
+        artifact_writer.write('./' + file_name + '/before_remove_touching_lines_1.png', before_splitting)
+        artifact_writer.write('./' + file_name + '/after_remove_touching_lines_1.png', to_view)
+        artifact_writer.write('./' + file_name + '/removed_touching_lines_1.png', image_no_tiny_elements * 255)
         image_no_tiny_elements, to_view, before_splitting, total_segmented, average_width = \
-            split_touching_lines(image_no_tiny_elements, average_width)
+            split_touching_lines(image_no_tiny_elements, average_width, clustering, executor)
+        fit_diagnostics.render('./' + file_name + '/touching_lines_2')
         if to_view is None:
             time_print(str_idx + 'No touching lines need to be split! 2 ')
         else:
             time_print(str_idx + 'LINES SPLIT DONE! REMOVED= ' + str(total_segmented))
-            cv2.imwrite('./' + file_name + '/before_remove_touching_lines_2.png', before_splitting)
-            cv2.imwrite('./' + file_name + '/after_remove_touching_lines_2.png', to_view)
-            cv2.imwrite('./' + file_name + '/removed_touching_lines_2.png', image_no_tiny_elements * 255)
+            artifact_writer.write('./' + file_name + '/before_remove_touching_lines_2.png', before_splitting)
+            artifact_writer.write('./' + file_name + '/after_remove_touching_lines_2.png', to_view)
+            artifact_writer.write('./' + file_name + '/removed_touching_lines_2.png', image_no_tiny_elements * 255)
 
     # add white border around image of size 29
     white_border_added_image = cv2.copyMakeBorder(image, 39, 39, 39, 39, cv2.BORDER_CONSTANT, None, 0)
@@ -468,8 +456,8 @@ def pre_process(path, file_name, str_idx=''):
     cv2.rectangle(white_border_added_image_no_tiny_elements, (0, 0),
                   (white_border_added_image_no_tiny_elements.shape[1] - 1,
                    white_border_added_image_no_tiny_elements.shape[0] - 1), 1)
-    cv2.imwrite('./' + file_name + '/rectangle_white_border_added_image_no_tiny_elements.png',
-                white_border_added_image_no_tiny_elements * 255)
+    artifact_writer.write('./' + file_name + '/rectangle_white_border_added_image_no_tiny_elements.png',
+                          white_border_added_image_no_tiny_elements * 255)
 
     x, y, w, h = cv2.boundingRect(white_border_added_image_no_tiny_elements)
     white_border_added_image_no_tiny_elements = white_border_added_image_no_tiny_elements[y: y + h, x: x + w]
@@ -483,124 +471,486 @@ def pre_process(path, file_name, str_idx=''):
     black_border_added = 1 - white_border_added_image
     black_border_added_no_tiny_elements = 1 - white_border_added_image_no_tiny_elements
 
-    cv2.imwrite('./' + file_name + '/preprocessed_image.png', black_border_added * 255)
-    cv2.imwrite('./' + file_name + '/preprocessed_image_inverted.png', 255 - black_border_added * 255)
-
-    cv2.imwrite('./' + file_name + '/preprocessed_image_no_tiny_elements.png', black_border_added_no_tiny_elements * 255)
-    cv2.imwrite('./' + file_name + '/preprocessed_image_no_tiny_elements_inverted.png',
-                255 - black_border_added_no_tiny_elements * 255)
+    artifact_writer.write('./' + file_name + '/preprocessed_image.png', black_border_added * 255, inverted=True)
+    artifact_writer.write('./' + file_name + '/preprocessed_image_no_tiny_elements.png',
+                          black_border_added_no_tiny_elements * 255, 'stages', inverted=True)
 
     return for_view, black_border_added_no_tiny_elements, anchors, image_offset_values
 
 
 # ---------------------------------------------------------------------------------
-# returns for edge (u,v) its shortest connected list of pixels from pixel u to pixel v
-def edge_bfs(start, end, skeleton):
-
-    visited = set()
-    to_visit = col.deque([start])
-    edges = col.deque()
-    done = False
-    while not done and to_visit:
-        current = to_visit.popleft()
-        visited.add(current)
-        candidates = [v for v in connected_candidates(current, skeleton)
-                      if v not in visited and v not in to_visit]
-        for vertex in candidates:
-            edges.append([current, vertex])
-            to_visit.append(vertex)
-            if vertex == end:
-                done = True
-    # find path from end -> start
-    final_edges = [end]
-    current = end
-    failed = False
-    while current != start and not failed:
-        sub_edges = list(filter(lambda item: item[1] == current, edges))
-        if sub_edges:
-            one_edge = sub_edges.pop()
-            final_edges.append(one_edge[0])
-            current = one_edge[0]
-        else:
-            failed = True
+# extract local maxima pixels - a pixel is a local maximum if it is greater than both pixels of one of six
+# opposite pairs around it, the pairs are the 5x5 kernels (two pixels each) of a dilation based test:
+# image > cv2.dilate(image, kernel) for each kernel and its transpose. pixels outside the image count as the
+# lowest value of the image type, as the cv2.dilate border does
+# offsets (row, col) of one pixel of each pair, the other pixel is at (-row, -col)
+local_maxima_offsets = np.asarray([(-2, 1), (-2, -1), (-2, 0), (1, -2), (-1, -2), (0, -2)], np.int64)
+
+
+def lowest_value(dtype):
+    return dtype.type(-np.inf) if np.issubdtype(dtype, np.floating) else dtype.type(np.iinfo(dtype).min)
+
+
+def local_maxima_numpy(image, offsets):
+    rows, cols = image.shape
+    padded = np.full((rows + 4, cols + 4), lowest_value(image.dtype), image.dtype)
+    padded[2: rows + 2, 2: cols + 2] = image
+    mask = np.zeros(image.shape, np.bool_)
+    neighbours = np.empty_like(image)
+    greater = np.empty(image.shape, np.bool_)
+    for d_row, d_col in offsets:
+        np.maximum(padded[2 + d_row: rows + 2 + d_row, 2 + d_col: cols + 2 + d_col],
+                   padded[2 - d_row: rows + 2 - d_row, 2 - d_col: cols + 2 - d_col], out=neighbours)
+        np.greater(image, neighbours, out=greater)
+        mask |= greater
+    return mask.view(np.uint8)
+
+
+def local_maxima_loops(image, offsets, lowest, mask):
+    rows, cols = image.shape
+    # inner pixels, every pair is inside the image. the pairs of local_maxima_offsets written out, one row each
+    for row in range(2, rows - 2):
+        up_2, up_1, middle, down_1, down_2 = image[row - 2], image[row - 1], image[row], image[row + 1], image[row + 2]
+        mask_row = mask[row]
+        for col in range(2, cols - 2):
+            value = middle[col]
+            mask_row[col] = ((value > max(up_2[col + 1], down_2[col - 1])) |
+                             (value > max(up_2[col - 1], down_2[col + 1])) |
+                             (value > max(up_2[col], down_2[col])) |
+                             (value > max(down_1[col - 2], up_1[col + 2])) |
+                             (value > max(up_1[col - 2], down_1[col + 2])) |
+                             (value > max(middle[col - 2], middle[col + 2])))
+
+    # pixels of the two pixel frame
+    for row in range(rows):
+        col = 0
+        while col < cols:
+            if 2 <= row < rows - 2 and col == 2 and cols > 4:
+                col = cols - 2
+            value = image[row, col]
+            for k in range(offsets.shape[0]):
+                row_1, col_1 = row + offsets[k, 0], col + offsets[k, 1]
+                row_2, col_2 = row - offsets[k, 0], col - offsets[k, 1]
+                neighbour_1 = image[row_1, col_1] if 0 <= row_1 < rows and 0 <= col_1 < cols else lowest
+                neighbour_2 = image[row_2, col_2] if 0 <= row_2 < rows and 0 <= col_2 < cols else lowest
+                if value > max(neighbour_1, neighbour_2):
+                    mask[row, col] = 1
+                    break
+            col += 1
+
+
+# single pass kernel, compiled on first use and kept for the process when numba is there
+local_maxima_kernel = numba.njit(nogil=True)(local_maxima_loops) if numba is not None else None
 
-    final_edges.append(start)
-    if failed:
-        print(start, end, 'fail')
-        return start, end, []
-    else:
-        return start, end, final_edges
+
+def calculate_local_maxima_mask(image):
+    image = np.ascontiguousarray(image)
+    if local_maxima_kernel is None:
+        return local_maxima_numpy(image, local_maxima_offsets)
+    mask = np.zeros(image.shape, np.uint8)
+    local_maxima_kernel(image, local_maxima_offsets, lowest_value(image.dtype), mask)
+    return mask
+
+
+def time_print(msg):
+    print('[' + str(datetime.datetime.now()) + ']', msg)
 
 
 # ---------------------------------------------------------------------------------
-# retrieves connected pixels that are part of the edge pixels
-# to be used for the bfs algorithm
-# 8 connected neighborhood of a pixel
-def connected_candidates(pixel, skeleton):
-    def add_offset(offset):
-        return tuple(map(op.add, pixel, offset))
-
-    def in_bounds_and_true(p):
-        r, c = add_offset(p)
-        if 0 <= r < skeleton.shape[0] and 0 <= c < skeleton.shape[1] and skeleton[r][c]:
-            return True
+# artifact writer - decides which of the images made along the way are written to disk
+# levels: 'none' - no images, 'final' - final result only, 'stages' - one image for each stage,
+# 'all' - every intermediate image. an inverted copy (255 - image) is made only if inverted is set
+# with workers, images are encoded and written by a thread pool (cv2.imencode releases the GIL) while the
+# pipeline goes on. at most max_pending images wait, images handed over are not copied and must not be changed
+# after. flush waits for all writes and reports the failed ones
+class ArtifactWriter:
+    levels = ['none', 'final', 'stages', 'all']
+
+    def __init__(self, level='all', inverted=True, workers=0, max_pending=16):
+        self.level = None
+        self.inverted = None
+        self.set_level(level, inverted)
+        self.workers = 0
+        self._pool = None
+        self._pending = None
+        # (path, future) of writes not flushed yet, (path, error) of failed writes
+        self._writes = []
+        self._failures = []
+        self.set_workers(workers, max_pending)
+
+    def set_level(self, level, inverted=True):
+        if level not in self.levels:
+            raise ValueError('unknown artifact level: ' + str(level))
+        self.level = level
+        self.inverted = inverted
+
+    def set_workers(self, workers, max_pending=16):
+        if self._pool is not None and workers == self.workers:
+            return
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.workers = workers
+        if workers > 0:
+            self._pool = futures.ThreadPoolExecutor(max_workers=workers)
+            self._pending = threading.BoundedSemaphore(max_pending)
+
+    # True if images of the given level are written
+    def writes(self, level):
+        return self.levels.index(level) <= self.levels.index(self.level)
+
+    # writes image to path if its level is written, and its inverted copy next to it (name_inverted.png)
+    def write(self, path, image, level='all', inverted=False):
+        if not self.writes(level):
+            return False
+        self._submit(path, image, False)
+        if inverted and self.inverted:
+            root, extension = os.path.splitext(path)
+            self._submit(root + '_inverted' + extension, image, True)
+        return True
+
+    def _submit(self, path, image, inverted):
+        if self._pool is None:
+            try:
+                self._write_file(path, image, inverted)
+            except Exception as error:
+                self._failures.append((path, error))
+            return
+        self._pending.acquire()
+        future = self._pool.submit(self._write_file, path, image, inverted)
+        future.add_done_callback(lambda done: self._pending.release())
+        self._writes.append((path, future))
+
+    @staticmethod
+    def _write_file(path, image, inverted):
+        if inverted:
+            image = 255 - image
+        encoded, buffer = cv2.imencode(os.path.splitext(path)[1], image)
+        if not encoded:
+            raise IOError('could not encode image')
+        buffer.tofile(path)
+
+    # waits for all pending writes, returns the failed writes as (path, error) and prints them
+    def flush(self):
+        for path, future in self._writes:
+            error = future.exception()
+            if error is not None:
+                self._failures.append((path, error))
+        self._writes = []
+        failures, self._failures = self._failures, []
+        for path, error in failures:
+            time_print('FAILED to write ' + path + ': ' + str(error))
+        return failures
+
+
+artifact_writer = ArtifactWriter()
+
+
+# ---------------------------------------------------------------------------------
+# fit diagnostics - keeps the gaussian fits of split_touching_lines for the components asked for, and
+# renders them to files after the fact. matplotlib is imported only when something is rendered
+# components is a collection of component labels, None keeps every component, empty keeps none (default)
+class FitDiagnostics:
+    colors = ['green', 'blue', 'red', 'yellow', 'magenta', 'brown', 'teal', 'purple', 'cyan', 'coral', 'olive',
+              'maroon']
+
+    def __init__(self, components=()):
+        self.components = None
+        self._fits = []
+        self.set_components(components)
+
+    def set_components(self, components):
+        self.components = None if components is None else set(components)
+
+    # True if the fits of the component are kept
+    def wants(self, label):
+        return self.components is None or label in self.components
+
+    # candidates - (params_n, good_n) of every n tried, as returned by get_n_cut_valleys
+    def add(self, label, histogram, candidates):
+        self._fits.append((label, np.asarray(histogram), candidates))
+
+    # renders every kept fit to path_fit_<label>_<n>.png and forgets them, returns the written paths
+    def render(self, path):
+        fits, self._fits = self._fits, []
+        if not fits:
+            return []
+        from matplotlib.figure import Figure
+
+        written = []
+        for label, histogram, candidates in fits:
+            x_s = np.arange(len(histogram))
+            for params_n, good_n in candidates:
+                if params_n is None:
+                    continue
+                figure = Figure()
+                axes = figure.subplots()
+                axes.plot(histogram, color='black', label='hist')
+                axes.set_xlim([0, len(histogram)])
+                for index, (mu, sigma, A) in enumerate(params_n):
+                    axes.plot(x_s, gauss(x_s, mu, sigma, A), color=self.colors[index], lw=3,
+                              label='gauss_' + str(index) + ' error=' + str(round(good_n[index], 2)))
+                axes.legend()
+                name = path + '_fit_' + str(label) + '_' + str(len(params_n)) + '.png'
+                figure.savefig(name)
+                written.append(name)
+        return written
+
+
+fit_diagnostics = FitDiagnostics()
+
+
+# ---------------------------------------------------------------------------------
+# edge store - pixels of all edges kept in one int32 (row, col) buffer, an edge is a slice of it
+# removed edges are only dropped when the buffer is reallocated, pixels handed out are read-only
+# views and stay valid after their edge is removed
+class EdgeStore:
+    def __init__(self, capacity=1024):
+        self._pixels = np.empty((capacity, 2), np.int32)
+        self._size = 0
+        self._garbage = 0
+        # edge id -> (start, stop) in pixels buffer
+        self._slices = dict()
+        self._next_id = 0
+
+    def add(self, pixels):
+        pixels = np.asarray(pixels, np.int32).reshape(-1, 2)
+        if self._size + len(pixels) > len(self._pixels):
+            self._reallocate(len(pixels))
+        start = self._size
+        self._size += len(pixels)
+        self._pixels[start: self._size] = pixels
+        edge_id = self._next_id
+        self._next_id += 1
+        self._slices[edge_id] = (start, self._size)
+        return edge_id
+
+    def remove(self, edge_id):
+        start, stop = self._slices.pop(edge_id)
+        self._garbage += stop - start
+
+    def __getitem__(self, edge_id):
+        start, stop = self._slices[edge_id]
+        pixels = self._pixels[start: stop]
+        pixels.flags.writeable = False
+        return pixels
+
+    def __len__(self):
+        return len(self._slices)
+
+    # copy live edges to a new buffer, leaving room for at least extra more pixels
+    def _reallocate(self, extra):
+        live = self._size - self._garbage
+        pixels = np.empty((max(2 * (live + extra), 1024), 2), np.int32)
+        size = 0
+        for edge_id, (start, stop) in self._slices.items():
+            pixels[size: size + stop - start] = self._pixels[start: stop]
+            self._slices[edge_id] = (size, size + stop - start)
+            size += stop - start
+        self._pixels = pixels
+        self._size = size
+        self._garbage = 0
+
+
+# ---------------------------------------------------------------------------------
+# joins pixel paths that follow each other (each path ends where the next one starts)
+# a junction pixel shared by two consecutive paths is kept once
+def concatenate_paths(*paths):
+    paths = [np.asarray(path, np.int32).reshape(-1, 2) for path in paths]
+    joined = [paths[0]]
+    for previous, path in zip(paths, paths[1:]):
+        if len(previous) and len(path) and np.array_equal(previous[-1], path[0]):
+            path = path[1:]
+        joined.append(path)
+    return np.concatenate(joined)
+
+
+# ---------------------------------------------------------------------------------
+# document graph - edge dictionary with undirected edge keys
+# each edge is stored under the key it was first inserted with, both (u,v) and (v,u) reach it.
+# every vertex keeps its incident edges (in insertion order), so finding the edges of a vertex
+# does not scan the whole edge dictionary.
+# edge pixels are kept in an EdgeStore, ordered from the first vertex of the key used to access them
+# for each edge a direction table holds its length, its orientation from either end and the direction
+# samples (first pixel on the ring of radius max_dist) around its ends, samples are taken once when needed
+class DocumentGraph(MutableMapping):
+    def __init__(self, edges=None):
+        # stored edge key -> edge id in store
+        self._edges = dict()
+        self._store = EdgeStore()
+        # vertex -> {neighbor: stored edge key}
+        self._incident = dict()
+        # stored edge key -> [length, {end vertex: orientation}, {(end vertex, max_dist): direction sample}]
+        self._directions = dict()
+        if edges is not None:
+            self.update(edges)
+
+    # stored key of edge (u,v) or (v,u), None if there is no such edge
+    def key(self, u, v):
+        neighbors = self._incident.get(u)
+        if neighbors is None:
+            return None
+        return neighbors.get(v)
+
+    def _stored_key(self, edge):
+        u, v = edge
+        key = self.key(u, v)
+        if key is None:
+            raise KeyError(edge)
+        return key
+
+    def __getitem__(self, edge):
+        key = self._stored_key(edge)
+        pixels = self._store[self._edges[key]]
+        return pixels if key[0] == edge[0] else pixels[::-1]
+
+    def __setitem__(self, edge, pixels):
+        u, v = edge
+        key = self.key(u, v)
+        if key is None:
+            key = tuple(edge)
+            self._incident.setdefault(u, dict())[v] = key
+            self._incident.setdefault(v, dict())[u] = key
         else:
+            self._store.remove(self._edges[key])
+            if key[0] != u:
+                pixels = np.asarray(pixels, np.int32).reshape(-1, 2)[::-1]
+        self._edges[key] = self._store.add(pixels)
+        key_u, key_v = key
+        delta_x = key_v[0] - key_u[0]
+        delta_y = key_v[1] - key_u[1]
+        self._directions[key] = [len(self._store[self._edges[key]]),
+                                 {key_u: np.abs(np.arctan2(delta_y, delta_x)),
+                                  key_v: np.abs(np.arctan2(-delta_y, -delta_x))}, dict()]
+
+    def __delitem__(self, edge):
+        key = self._stored_key(edge)
+        u, v = key
+        self._store.remove(self._edges.pop(key))
+        del self._directions[key]
+        for p, q in [(u, v), (v, u)]:
+            neighbors = self._incident.get(p)
+            if neighbors is not None:
+                neighbors.pop(q, None)
+                if not neighbors:
+                    del self._incident[p]
+
+    def __contains__(self, edge):
+        try:
+            u, v = edge
+        except (TypeError, ValueError):
             return False
+        return self.key(u, v) is not None
+
+    def __iter__(self):
+        return iter(self._edges)
+
+    def __len__(self):
+        return len(self._edges)
+
+    # stored keys of all edges of vertex v
+    def incident(self, v):
+        return list(self._incident.get(v, {}).values())
+
+    # other end of all edges of vertex v
+    def neighbors(self, v):
+        return list(self._incident.get(v, {}).keys())
+
+    def degree(self, v):
+        return len(self._incident.get(v, {}))
+
+    def vertexes(self):
+        return list(self._incident.keys())
+
+    # number of pixels of edge (u,v)
+    def length(self, edge):
+        return self._directions[self._stored_key(edge)][0]
 
-    eight_connected = list(filter(in_bounds_and_true, [(1, 0), (0, 1), (-1, 0), (0, -1),
-                                                                      (1, 1), (-1, 1), (-1, -1), (1, -1)]))
+    # absolute angle of edge (u,v) relative to x axis, as seen from u
+    def orientation(self, edge):
+        return self._directions[self._stored_key(edge)][1][edge[0]]
 
-    return [add_offset(offset) for offset in eight_connected]
+    # direction sample of edge (v,w) around v - its first pixel on the ring of radius max_dist around v,
+    # w itself if the edge does not reach the ring
+    def direction(self, v, w, max_dist):
+        key = self._stored_key((v, w))
+        samples = self._directions[key][2]
+        if (v, max_dist) not in samples:
+            pixel = get_ring_pixel(v, self._store[self._edges[key]], max_dist)
+            samples[(v, max_dist)] = w if pixel is None else pixel
+        return samples[(v, max_dist)]
 
 
 # ---------------------------------------------------------------------------------
-# extract local maxima pixels
-def calculate_local_maxima_mask(image):
-    def uint8_array(rows):
-        return np.array(rows).astype(np.uint8)
-
-    base = list(map(uint8_array, [
-        [
-            [0, 0, 0, 1, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 1, 0, 0, 0],
-        ],
-        [
-            [0, 1, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0,  1, 0],
-        ],
-        [
-            [0, 0, 1, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 0, 0, 0],
-            [0, 0, 1, 0, 0],
-        ],
-    ]))
-
-    kernels = [mat for mat in base + [mat.T for mat in base]]
-
-    local_maxima_result = (image > cv2.dilate(image, kernel)
-                           for kernel in kernels)
-
-    return ft.reduce(op.or_, local_maxima_result).astype(np.uint8)
+# degree pruning of a document graph, driven by a worklist of vertexes to check
+# All vertexes with one degree (take part of one edge only) - they are removed, unless excluded
+# All vertexes with two degree (take part of two edges exactly) - their edges are merged
+# a vertex is checked again whenever its degree drops, until the worklist is empty
+def prune_graph_degrees(graph, worklist, exclude, excluded):
+    while worklist:
+        item = worklist.popleft()
+        degree = graph.degree(item)
+        # 1 degree vertexes are to be removed from graph
+        if degree == 1:
+            if item in exclude:
+                excluded[item] = True
+                continue
+            neighbor = graph.neighbors(item)[0]
+            graph.pop((item, neighbor))
+            worklist.append(neighbor)
+        # 2 degree vertexes need their edges to be merged
+        elif degree == 2:
+            # merged edge runs in raster order, like the edges skan gives
+            u, w = sorted(graph.neighbors(item))
+            pixels = concatenate_paths(graph.pop((u, item)), graph.pop((item, w)))
+            parallel = graph.key(u, w)
+            if parallel is not None:
+                # u and w are already connected, the shorter edge of the two is kept
+                worklist.extend([u, w])
+                if graph.length(parallel) <= len(pixels):
+                    continue
+            graph[(u, w)] = pixels
 
 
-def time_print(msg):
-    print('[' + str(datetime.datetime.now()) + ']', msg)
+# ---------------------------------------------------------------------------------
+# filter out circles -> (u,v) (v,w) (w,u), then (w,u) is removed
+# (w,u) is the longest line out of the three in a 3-edge circle
+# returns the removed edges
+def remove_graph_circles(graph):
+    remove_candidates = set()
+    for result in graph.keys():
+        v, u = result
+        candidates_v_w = [w for w in graph.neighbors(v) if w != u and w != v]
+        candidates_u_w = set(w for w in graph.neighbors(u) if w != v and w != u)
+        for w in candidates_v_w:
+            if w in candidates_u_w:
+                candidate_vu = graph.key(v, u)
+                len_vu = graph.length(candidate_vu)
+                candidate_wv = graph.key(w, v)
+                len_wv = graph.length(candidate_wv)
+                candidate_uw = graph.key(u, w)
+                len_uw = graph.length(candidate_uw)
+                if len_vu > len_uw and len_vu > len_wv:
+                    remove_candidates.add(candidate_vu)
+                elif len_uw > len_vu and len_uw > len_wv:
+                    remove_candidates.add(candidate_uw)
+                elif len_wv > len_vu and len_wv > len_vu:
+                    remove_candidates.add(candidate_wv)
+    # remove all edges that create a 3-edged circle,
+    # for each edge the removed edge is the longest of all 3-edges of the circle
+    for edge in remove_candidates:
+        graph.pop(edge)
+    return remove_candidates
 
 
 # ---------------------------------------------------------------------------------
 # All vertexes with one degree (take part of one edge only) - they are removed
 # All vertexes with two degree (take part of two edges exactly) - they are merged
 # if three edges create a three edged circle: (u,v) (v,w) (w,u), we remove (w,u)
-# this is done iteratively, until all vertexes have a degree of three or more!
-def prune_graph(skeleton, iter_index, file_name, anchors, idx_str=''):
+# the skeleton graph is built once, then pruned as a graph until all vertexes have a degree
+# of three or more and no circles are left. only the pruned graph is drawn back to a skeleton
+def prune_graph(skeleton, file_name, anchors, idx_str='', thin=False):
     def in_bounds(p):
         r, c = p
         if 0 <= r < skeleton.shape[1] and 0 <= c < skeleton.shape[0]:
@@ -615,191 +965,79 @@ def prune_graph(skeleton, iter_index, file_name, anchors, idx_str=''):
         max_dist_candidates_y = list(map(lambda y: y + v_y, max_dist_v))
         return [(x, y) for x in max_dist_candidates_x for y in max_dist_candidates_y if in_bounds((x, y))]
 
-    def unique_rows(a):
-        a = np.ascontiguousarray(a)
-        unique_a = np.unique(a.view([('', a.dtype)] * a.shape[1]))
-        return unique_a.view(a.dtype).reshape((unique_a.shape[0], a.shape[1]))
-
-    def identical(e1, e2):
-        return e1[0] == e2[0] and e1[1] == e2[1]
-
-    cv2.imwrite('./' + file_name + '/skel_' + str(iter_index) + '.png', skeleton.astype(np.uint8) * 255)
-    cv2.imwrite('./' + file_name + '/skel_' + str(iter_index) + '_inverted.png', 255 - skeleton.astype(np.uint8) * 255)
-    # important! removes pixels due to vertex removal from previous iteration
-    skeleton = morphology.skeletonize(skeleton)
-    branch_data = csr.summarise(skeleton)
-    coords_cols = (['img-coord-0-%i' % i for i in [1, 0]] +
-                   ['img-coord-1-%i' % i for i in [1, 0]])
-    # removes duplicate entries!
-    coords = unique_rows(branch_data[coords_cols].values).reshape((-1, 2, 2))
-    try_again = False
-
-    len_before = len(coords)
-    excludes = anchors
-    exclude = []
-    excluded = []
-    for ex in excludes:
-        exclude.extend(add_range(ex))
-
-    done = False
-    while not done:
-        changed = False
-        flat_coords = [tuple(val) for sublist in coords for val in sublist]
-        unique_flat_coords = list(set(flat_coords))
-        current = 0
-        while not changed and current < len(unique_flat_coords):
-            item = unique_flat_coords[current]
-            current += 1
-            # 1 degree vertexes are to be removed from graph
-            if flat_coords.count(item) < 2:
-                # print('item=', item)
-                if item in exclude:
-                    excluded.append((item[1], item[0]))
-                    continue
-                changed = True
-                coords = list(filter(lambda x: tuple(x[0]) != item and tuple(x[1]) != item, coords))
-            # 2 degree vertexes need their edges to be merged
-            elif flat_coords.count(item) == 2:
-                changed = True
-                fc = list(filter(lambda x: tuple(x[0]) == item or tuple(x[1]) == item, coords))
-                # print('flat_coords.count(item)=', flat_coords.count(item), 'fc=', fc)
-                if len(fc) != 2:
-                    print('item=', item, 'fc=', fc)
-                coords = list(filter(lambda x: tuple(x[0]) != item and tuple(x[1]) != item, coords))
-                e1_s = fc[0][0]
-                e1_e = fc[0][1]
-                e2_s = fc[1][0]
-                e2_e = fc[1][1]
-                if ft.reduce(op.and_, map(lambda e: e[0] == e[1], zip(e1_s, e2_s))) and \
-                        not identical(e1_e, e2_e):
-                    coords.append(np.array([e1_e, e2_e]))
-                elif ft.reduce(op.and_, map(lambda e: e[0] == e[1], zip(e1_s, e2_e))) and \
-                        not identical(e1_e, e2_s):
-                    coords.append(np.array([e1_e, e2_s]))
-                elif ft.reduce(op.and_, map(lambda e: e[0] == e[1], zip(e1_e, e2_s))) and \
-                        not identical(e1_s, e2_e):
-                    coords.append(np.array([e1_s, e2_e]))
-                elif ft.reduce(op.and_, map(lambda e: e[0] == e[1], zip(e1_e, e2_e))) and \
-                        not identical(e1_s, e2_s):
-                    coords.append(np.array([e1_s, e2_s]))
-                else:
-                    changed = False
-        if not changed:
-            done = True
-            time_print(idx_str + 'before= ' + str(len_before) + ' after= ' + str(len(coords)))
-            try_again = len_before != len(coords)
-
-    skel = cv2.cvtColor(skeleton.astype(np.uint8) * 255, cv2.COLOR_GRAY2RGB)
-
-    tmp_skel = copy.deepcopy(skeleton)
-    for coord in coords:
-        start, end = coord
-        start = (start[1], start[0])
-        end = (end[1], end[0])
-        # print(start, end)
-        start_neighborhood = connected_candidates(start, skeleton)
-        end_neighborhood = connected_candidates(end, skeleton)
-        for point in start_neighborhood + end_neighborhood:
-            tmp_skel[point] = False
-        tmp_skel[start] = False
-        tmp_skel[end] = False
-
-    cv2.imwrite('./' + file_name + '/base_' + str(iter_index) + '.png', tmp_skel.astype(np.uint8) * 255)
-
-    # create results, for each edge, we find its corresponding pixels
-    # result list contains edge information: (start, end, [pixels])
-    results = []
-    results_dict = dict()
-    for edge in coords:
-        start, end = edge
-        start = (start[1], start[0])
-        end = (end[1], end[0])
-        start_neighborhood = connected_candidates(start, skeleton)
-        end_neighborhood = connected_candidates(end, skeleton)
-        for point in start_neighborhood + end_neighborhood:
-            tmp_skel[point] = True
-        tmp_skel[start] = True
-        tmp_skel[end] = True
-        _, _, result = edge_bfs(start, end, tmp_skel)
-        start_neighborhood = connected_candidates(start, skeleton)
-        end_neighborhood = connected_candidates(end, skeleton)
-        for point in start_neighborhood + end_neighborhood:
-             tmp_skel[point] = False
-        tmp_skel[start] = False
-        tmp_skel[end] = False
-        results.append((start, end, result))
-        results_dict[(start, end)] = result
-
-    # filter out circles -> (u,v) (v,w) (w,u), then (w,u) is removed
-    # (w,u) is the longest line out of the three in a 3-edge circle
-    remove_candidates = set()
-    for result in results_dict.keys():
-        v, u = result
-        candidates_v = [e for e in results_dict.keys() if v in e and u not in e]
-        candidates_v_w = [e[0] if e[1] == v else e[1] for e in candidates_v]
-        candidates_u = [e for e in results_dict.keys() if u in e and v not in e]
-        candidates_u_w = [e[0] if e[1] == u else e[1] for e in candidates_u]
-        for vw in candidates_v_w:
-            for uw in candidates_u_w:
-                if vw == uw:
-                    w = vw
-                    if (v, u) in results_dict.keys():
-                        candidate_vu = (v, u)
-                        len_vu = len(results_dict[(v, u)])
-                    else:
-                        candidate_vu = (u, v)
-                        len_vu = len(results_dict[(u, v)])
-
-                    if (w, v) in results_dict.keys():
-                        candidate_wv = (w, v)
-                        len_wv = len(results_dict[(w, v)])
-                    else:
-                        candidate_wv = (v, w)
-                        len_wv = len(results_dict[(v, w)])
-
-                    if (u, w) in results_dict.keys():
-                        candidate_uw = (u, w)
-                        len_uw = len(results_dict[(u, w)])
-                    else:
-                        candidate_uw = (w, u)
-                        len_uw = len(results_dict[(w, u)])
-                    if len_vu > len_uw and len_vu > len_wv:
-                        remove_candidates.add(candidate_vu)
-                    elif len_uw > len_vu and len_uw > len_wv:
-                        remove_candidates.add(candidate_uw)
-                    elif len_wv > len_vu and len_wv > len_vu:
-                        remove_candidates.add(candidate_wv)
-    # remove all edges that create a 3-edged circle,
-    # for each edge the removed edge is the longest of all 3-edges of the circle
-    time_print(idx_str + 'removing circles ...')
-    remove_items = [(edge[0], edge[1], results_dict.pop(edge)) for edge in remove_candidates]
-    # if no edge was removed above, but a circle is removed, we need a new iteration due to changes.
-    if remove_items:
-        try_again = True
-    time_print(idx_str + 'before= ' + str(len(results)) + ' to_remove= ' + str(len(remove_items)))
-    results = list(filter(lambda element: element not in remove_items, results))
+    artifact_writer.write('./' + file_name + '/skel_0.png', skeleton.astype(np.uint8) * 255, inverted=True)
+    # zhang-suen thinning stops at a fixed point, so an already skeletonized input is left as is
+    if not thin:
+        skeleton = morphology.skeletonize(skeleton)
+    skeleton_graph = csr.Skeleton(skeleton)
+
+    # create results, for each edge, skan already holds its pixels ordered from start to end
+    # results graph maps each edge (start, end) to its pixels, of parallel edges the shortest is kept
+    results = DocumentGraph()
+    for i in range(skeleton_graph.n_paths):
+        path = np.round(skeleton_graph.path_coordinates(i)).astype(int)
+        start, end = tuple(path[0]), tuple(path[-1])
+        if start == end:  # TODO WHY THE GRAPH HAS THESE EDGES? BUG IN LIBRARY?
+            continue
+        if (start, end) not in results or len(path) < results.length((start, end)):
+            results[(start, end)] = path
+
+    # skeleton without the vertexes and their neighborhoods, stored to image for illustration
+    if artifact_writer.writes('all'):
+        vertex_mask = np.zeros_like(skeleton, np.uint8)
+        for vertex in results.vertexes():
+            vertex_mask[vertex] = 1
+        vertex_mask = cv2.dilate(vertex_mask, np.ones((3, 3), np.uint8)).astype(bool)
+        artifact_writer.write('./' + file_name + '/base_0.png', (skeleton & ~vertex_mask).astype(np.uint8) * 255)
+
+    # anchor areas are given as (x, y), graph vertexes are (row, col)
+    exclude = set((y, x) for ex in anchors for x, y in add_range(ex))
+    excluded = dict()
+
+    # prune degrees, then circles, until nothing changes
+    len_before = len(results)
+    worklist = col.deque(results.vertexes())
+    iter_index = 0
+    while worklist:
+        prune_graph_degrees(results, worklist, exclude, excluded)
+        time_print(idx_str + 'iter ' + str(iter_index) + ' removing circles ...')
+        for u, v in remove_graph_circles(results):
+            worklist.extend([u, v])
+        iter_index += 1
+    time_print(idx_str + 'before= ' + str(len_before) + ' after= ' + str(len(results)))
+    excluded = [item for item in excluded if results.degree(item) == 1]
+    # edges are listed by (col, row) of their start, then of their end - the order skan summarise gave them
+    results = DocumentGraph((edge, results[edge]) for edge in
+                            sorted(results.keys(), key=lambda e: (e[0][1], e[0][0], e[1][1], e[1][0])))
 
     # create new skeleton following graph pruning
     skel = np.zeros_like(skeleton)
-    for result in results:
-        u, v, pixel_list = result
-        for point in pixel_list:
-            skel[point] = True
-
-    # create result image after iteration is done and store to image for illustration
-    colors = []
-    image = cv2.cvtColor(np.zeros_like(skeleton, np.uint8), cv2.COLOR_GRAY2RGB)
-    for result in results:
-        start, end, edge_list = result
-        random_color = (rd.randint(50, 200), rd.randint(50, 200), rd.randint(50, 200))
-        while random_color in colors:
+    for pixel_list in results.values():
+        skel[pixel_list[:, 0], pixel_list[:, 1]] = True
+
+    # create result image after pruning is done and store to image for illustration
+    if artifact_writer.writes('all'):
+        colors = []
+        image = cv2.cvtColor(np.zeros_like(skeleton, np.uint8), cv2.COLOR_GRAY2RGB)
+        for edge_list in results.values():
             random_color = (rd.randint(50, 200), rd.randint(50, 200), rd.randint(50, 200))
-        for point in edge_list:
-            image[point] = random_color
-        colors.append(random_color)
-    cv2.imwrite('./' + file_name + '/iter_' + str(iter_index) + '.png', image)
-    cv2.imwrite('./' + file_name + '/iter_' + str(iter_index) + '_inverted.png', 255 - image)
-    return skel, results, excluded, try_again
+            while random_color in colors:
+                random_color = (rd.randint(50, 200), rd.randint(50, 200), rd.randint(50, 200))
+            image[edge_list[:, 0], edge_list[:, 1]] = random_color
+            colors.append(random_color)
+        artifact_writer.write('./' + file_name + '/iter_' + str(iter_index) + '.png', image, inverted=True)
+    return skel, results, excluded
+
+
+# ---------------------------------------------------------------------------------
+# biggest 8 connected component of a binary mask, in the mask type
+# the mask is binary, so a single labelling covers it; label 0 is the background
+def largest_component(mask):
+    num_labels, labels, stats = cv2.connectedComponentsWithStats(mask, connectivity=8)[:3]
+    if num_labels < 2:
+        return np.zeros_like(mask)
+    largest_label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    return (labels == largest_label).astype(mask.dtype)
 
 
 # ---------------------------------------------------------------------------------
@@ -810,52 +1048,34 @@ def ridge_extraction(image_preprocessed, file_name, anchors, idx_str=''):
 
     # normalize distance transform to be of values [0,1]
     normalized_dist_transform = cv2.normalize(dist_transform, None, 0, 1.0, cv2.NORM_MINMAX)
-    cv2.imwrite('./' + file_name + '/normalized_dist_transform.png', normalized_dist_transform * 255)
-    cv2.imwrite('./' + file_name + '/normalized_dist_transform_inverted.png', 255 - normalized_dist_transform * 255)
+    artifact_writer.write('./' + file_name + '/normalized_dist_transform.png', normalized_dist_transform * 255,
+                          inverted=True)
     # extract local maxima pixels -- "ridge pixels"
     dist_maxima_mask = calculate_local_maxima_mask(normalized_dist_transform)
     # retrieve the biggest connected component only
-    dist_maxima_mask_biggest_component = np.zeros_like(dist_maxima_mask)
-
-    for val in np.unique(dist_maxima_mask)[1:]:
-        mask = np.uint8(dist_maxima_mask == val)
-        labels, stats = cv2.connectedComponentsWithStats(mask, 4)[1:3]
-        largest_label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
-        dist_maxima_mask_biggest_component[labels == largest_label] = val
+    dist_maxima_mask_biggest_component = largest_component(dist_maxima_mask)
     skeleton = morphology.skeletonize(dist_maxima_mask_biggest_component)
 
-    cv2.imwrite('./' + file_name + '/skeleton_original.png', dist_maxima_mask_biggest_component.astype(np.uint8) * 255)
-    cv2.imwrite('./' + file_name + '/skeleton_original_inverted.png', 255 - dist_maxima_mask_biggest_component.astype(np.uint8) * 255)
-    changed = True
-    results = []
-    iter_index = 0
+    artifact_writer.write('./' + file_name + '/skeleton_original.png',
+                          dist_maxima_mask_biggest_component.astype(np.uint8) * 255, inverted=True)
     time_print(idx_str + 'pruning redundant edges and circles...')
-    excluded = []
-    while changed:
-        time_print(idx_str + 'iter ' + str(iter_index))
-        skeleton, results, excluded, changed = prune_graph(skeleton, iter_index, file_name, anchors, idx_str)
-        iter_index += 1
+    skeleton, results, excluded = prune_graph(skeleton, file_name, anchors, idx_str, thin=True)
     time_print(idx_str + 'done')
 
-    colors = []
-    image = cv2.cvtColor(np.zeros_like(skeleton, np.uint8), cv2.COLOR_GRAY2RGB)
-    edge_dictionary = dict()
-    for result in results:
-        start, end, edge_list = result
-        if start == end:  # TODO WHY THE GRAPH HAS THESE EDGES? BUG IN LIBRARY?
-            continue
-        edge_dictionary[(start, end)] = edge_list
-        random_color = (rd.randint(50, 200), rd.randint(50, 200), rd.randint(50, 200))
-        while random_color in colors:
+    edge_dictionary = results
+    if artifact_writer.writes('stages'):
+        colors = []
+        image = cv2.cvtColor(np.zeros_like(skeleton, np.uint8), cv2.COLOR_GRAY2RGB)
+        for edge_list in edge_dictionary.values():
             random_color = (rd.randint(50, 200), rd.randint(50, 200), rd.randint(50, 200))
-        for point in edge_list:
-            image[point] = random_color
-        colors.append(random_color)
-    cv2.imwrite('./' + file_name + '/skeleton_pruned.png', image)
-    cv2.imwrite('./' + file_name + '/skeleton_pruned_inverted.png', 255 - image)
+            while random_color in colors:
+                random_color = (rd.randint(50, 200), rd.randint(50, 200), rd.randint(50, 200))
+            image[edge_list[:, 0], edge_list[:, 1]] = random_color
+            colors.append(random_color)
+        artifact_writer.write('./' + file_name + '/skeleton_pruned.png', image, 'stages', inverted=True)
 
     # get vertexes
-    graph_vertexes = list(set([tuple(val) for sublist in edge_dictionary.keys() for val in sublist]))
+    graph_vertexes = edge_dictionary.vertexes()
 
     return skeleton, edge_dictionary, graph_vertexes, excluded
 
@@ -890,116 +1110,59 @@ def calculate_abs_angle_difference(u, v, w):
 
 
 # ---------------------------------------------------------------------------------
-# calculates angle between three points, result in radians
-# using Decimal for increased precision
-def calculate_abs_angle(u, v, w):
-    # angle between u, v and v, w
-    getcontext().prec = 28
+# calculates angles of a batch of point triples (u, v, w), shaped (N, 3, 2), result in radians
+# angle between u, v and v, w - a zero length vector is given the length 0.0001
+def calculate_abs_angles(triples):
+    triples = np.asarray(triples, np.float64).reshape((-1, 3, 2))
+    vector_1 = triples[:, 0] - triples[:, 1]
+    vector_2 = triples[:, 2] - triples[:, 1]
 
-    u_x, u_y = u
-    v_x, v_y = v
-    w_x, w_y = w
+    dot = np.einsum('ij,ij->i', vector_1, vector_2)
+    norma_1 = np.einsum('ij,ij->i', vector_1, vector_1)
+    norma_2 = np.einsum('ij,ij->i', vector_2, vector_2)
+    norma_1[norma_1 == 0.0] = 0.0001 ** 2
+    norma_2[norma_2 == 0.0] = 0.0001 ** 2
+    # squared norms are exact for pixel coordinates, a single square root keeps the rounding low
+    val = np.clip(dot / np.sqrt(norma_1 * norma_2), -1.0, 1.0)
 
-    x1 = (u_x - v_x).item()
-    y1 = (u_y - v_y).item()
-    x2 = (w_x - v_x).item()
-    y2 = (w_y - v_y).item()
+    return np.abs(np.arccos(val))
 
-    dot = Decimal(x1 * x2 + y1 * y2)
-    norma_1 = Decimal(x1 * x1 + y1 * y1).sqrt()
-    norma_2 = Decimal(x2 * x2 + y2 * y2).sqrt()
-    if norma_1 == 0.0:
-        print('norma_1==0->', u, v, w)
-        norma_1 = Decimal(0.0001)
-    if norma_2 == 0.0:
-        print('norma_2==0->', u, v, w)
-        norma_2 = Decimal(0.0001)
-    val = dot / (norma_1 * norma_2)
 
-    return np.abs(np.arccos(float(val)))
+# ---------------------------------------------------------------------------------
+# calculates angle between three points, result in radians
+def calculate_abs_angle(u, v, w):
+    return calculate_abs_angles((u, v, w))[0]
 
 
-def get_nearby_pixels_two_edges(v, w1, w2, edges_dictionary, max_dist):
+# ---------------------------------------------------------------------------------
+# first pixel of an edge on the square ring of radius max_dist around v
+# ring pixels are visited by columns: left, right, top then bottom, None if the edge does not cross the ring
+def get_ring_pixel(v, pixels, max_dist):
     v_x, v_y = v
-    max_dist_v = [x for x in range(-max_dist, max_dist + 1)]
-    max_dist_candidates_x = list(map(lambda x: x + v_x, max_dist_v))
-    max_dist_candidates_y = list(map(lambda y: y + v_y, max_dist_v))
-
-    left_column = list(map(lambda e: (v_x - max_dist, e), max_dist_candidates_y))
-    right_column = list(map(lambda e: (v_x + max_dist, e), max_dist_candidates_y))
-    top_column = list(map(lambda e: (e, v_y - max_dist), max_dist_candidates_x))
-    bottom_column = list(map(lambda e: (e, v_y + max_dist), max_dist_candidates_x))
-
-    junction_pixels = dict()
-    if tuple([v, w1]) in edges_dictionary.keys():
-        junction_pixels[tuple([v, w1])] = edges_dictionary[tuple([v, w1])]
-    else:
-        junction_pixels[tuple([v, w1])] = edges_dictionary[tuple([w1, v])]
-
-    if tuple([v, w2]) in edges_dictionary.keys():
-        junction_pixels[tuple([v, w2])] = edges_dictionary[tuple([v, w2])]
-    else:
-        junction_pixels[tuple([v, w2])] = edges_dictionary[tuple([w2, v])]
-
-    w1_in_radius = [i for i in left_column + right_column + top_column + bottom_column
-                    if i in junction_pixels[(v, w1)]]
-    if len(w1_in_radius) == 0:
-        w1_in_radius = [w1]
+    offsets = np.asarray(pixels, np.int64).reshape(-1, 2) - (v_x, v_y)
+    ring = offsets[np.max(np.abs(offsets), axis=1) == max_dist]
+    if len(ring) == 0:
+        return None
+    side = 2 * max_dist + 1
+    order = np.where(ring[:, 0] == -max_dist, ring[:, 1],
+                     np.where(ring[:, 0] == max_dist, side + ring[:, 1],
+                              np.where(ring[:, 1] == -max_dist, 2 * side + ring[:, 0], 3 * side + ring[:, 0])))
+    first = np.argmin(order)
+    return v_x + ring[first, 0], v_y + ring[first, 1]
 
-    w2_in_radius = [i for i in left_column + right_column + top_column + bottom_column
-                    if i in junction_pixels[(v, w2)]]
-    if len(w2_in_radius) == 0:
-        w2_in_radius = [w2]
 
-    return w1_in_radius[0], w2_in_radius[0]
+def get_nearby_pixels_two_edges(v, w1, w2, edges_dictionary, max_dist):
+    return edges_dictionary.direction(v, w1, max_dist), edges_dictionary.direction(v, w2, max_dist)
 
 
 # ---------------------------------------------------------------------------------
 # get_nearby_pixels
 #
 def get_nearby_pixels(u, v, w1, w2, edges_dictionary, max_dist):
-    v_x, v_y = v
-    max_dist_v = [x for x in range(-max_dist, max_dist + 1)]
-    max_dist_candidates_x = list(map(lambda x: x + v_x, max_dist_v))
-    max_dist_candidates_y = list(map(lambda y: y + v_y, max_dist_v))
-
-    left_column = list(map(lambda e: (v_x - max_dist, e), max_dist_candidates_y))
-    right_column = list(map(lambda e: (v_x + max_dist, e), max_dist_candidates_y))
-    top_column = list(map(lambda e: (e, v_y - max_dist), max_dist_candidates_x))
-    bottom_column = list(map(lambda e: (e, v_y + max_dist), max_dist_candidates_x))
-
-    junction_pixels = dict()
-    if tuple([u, v]) in edges_dictionary.keys():
-        junction_pixels[tuple([u, v])] = edges_dictionary[tuple([u, v])]
-    else:
-        junction_pixels[tuple([u, v])] = edges_dictionary[tuple([v, u])]
-
-    if tuple([v, w1]) in edges_dictionary.keys():
-        junction_pixels[tuple([v, w1])] = edges_dictionary[tuple([v, w1])]
-    else:
-        junction_pixels[tuple([v, w1])] = edges_dictionary[tuple([w1, v])]
-
-    if tuple([v, w2]) in edges_dictionary.keys():
-        junction_pixels[tuple([v, w2])] = edges_dictionary[tuple([v, w2])]
-    else:
-        junction_pixels[tuple([v, w2])] = edges_dictionary[tuple([w2, v])]
+    in_w1, in_w2 = get_nearby_pixels_two_edges(v, w1, w2, edges_dictionary, max_dist)
+    in_u = edges_dictionary.direction(v, u, max_dist)
 
-    w1_in_radius = [i for i in left_column + right_column + top_column + bottom_column
-                    if i in junction_pixels[(v, w1)]]
-    if len(w1_in_radius) == 0:
-        w1_in_radius = [w1]
-
-    w2_in_radius = [i for i in left_column + right_column + top_column + bottom_column
-                    if i in junction_pixels[(v, w2)]]
-    if len(w2_in_radius) == 0:
-        w2_in_radius = [w2]
-
-    u_in_radius = [i for i in left_column + right_column + top_column + bottom_column
-                   if i in junction_pixels[(u, v)]]
-    if len(u_in_radius) == 0:
-        u_in_radius = [u]
-
-    return u_in_radius[0], w1_in_radius[0], w2_in_radius[0]
+    return in_u, in_w1, in_w2
 
 
 # ---------------------------------------------------------------------------------
@@ -1007,16 +1170,11 @@ def get_nearby_pixels(u, v, w1, w2, edges_dictionary, max_dist):
 #
 def calculate_edge_scores_local(u, v, edge_dictionary, t_scores, max_dist):
     # print('u=', u, 'v=', v)
-    junction_v_edges = [edge for edge in edge_dictionary
-                        if (edge[0] == v and edge[1] != u) or (edge[0] != u and edge[1] == v)]
-    # print(junction_v_edges)
-    v_edges = [e[0] if e[1] == v else e[1] for e in junction_v_edges]
+    v_edges = [w for w in edge_dictionary.neighbors(v) if w != u]
     for combination in it.combinations(v_edges, 2):
         w1, w2 = combination
         in_u, in_w1, in_w2 = get_nearby_pixels(u, v, w1, w2, edge_dictionary, max_dist=max_dist)
-        uv_vw1 = calculate_abs_angle(in_u, v, in_w1)
-        uv_vw2 = calculate_abs_angle(in_u, v, in_w2)
-        w1v_vw2 = calculate_abs_angle(in_w1, v, in_w2)
+        uv_vw1, uv_vw2, w1v_vw2 = calculate_abs_angles([(in_u, v, in_w1), (in_u, v, in_w2), (in_w1, v, in_w2)])
         uv_bridge = np.abs(np.pi - w1v_vw2) + np.abs(np.pi / 2.0 - uv_vw1) + np.abs(np.pi / 2.0 - uv_vw2)
         vw1_bridge = np.abs(np.pi - uv_vw1) + np.abs(np.pi / 2.0 - uv_vw2) + np.abs(np.pi / 2.0 - w1v_vw2)
         vw2_bridge = np.abs(np.pi - uv_vw2) + np.abs(np.pi / 2.0 - uv_vw1) + np.abs(np.pi / 2.0 - w1v_vw2)
@@ -1028,12 +1186,12 @@ def calculate_edge_scores_local(u, v, edge_dictionary, t_scores, max_dist):
 # totals 6 possible combinations
 #
 def calculate_edge_scores(u, v, edge_dictionary, t_scores, excluded, max_dist=None):
-    junction_v_edges = [edge for edge in edge_dictionary
-                        if (edge[0] == v and edge[1] != u) or (edge[0] != u and edge[1] == v)]
-    v_edges = [e[0] if e[1] == v else e[1] for e in junction_v_edges]
+    v_edges = [w for w in edge_dictionary.neighbors(v) if w != u]
 
     # For each edge we check u,v v,w1 v,w2
     # other side below...
+    combinations = []
+    triples = []
     for combination in it.combinations(v_edges, 2):
         w1, w2 = combination
         # print(w1)
@@ -1047,21 +1205,25 @@ def calculate_edge_scores(u, v, edge_dictionary, t_scores, excluded, max_dist=No
             in_w2 = w2
         else:
             in_u, in_w1, in_w2 = get_nearby_pixels(u, v, w1, w2, edge_dictionary, max_dist=max_dist)
-        u_s = [u, in_u]
-        w1_s = [w1, in_w1]
-        w2_s = [w2, in_w2]
-        uv_vw1 = [calculate_abs_angle(one_u, v, one_w1) for one_u in u_s for one_w1 in w1_s]
-        uv_vw2 = [calculate_abs_angle(one_u, v, one_w2) for one_u in u_s for one_w2 in w2_s]
-        w1v_vw2 = [calculate_abs_angle(one_w1, v, one_w2) for one_w1 in w1_s for one_w2 in w2_s]
-        uv_bridge = np.min([np.abs(np.pi - one_w1v_vw2) + np.abs(np.pi / 2.0 - one_uv_vw1) +
-                            np.abs(np.pi / 2.0 - one_uv_vw2) for one_w1v_vw2 in w1v_vw2
-                            for one_uv_vw1 in uv_vw1 for one_uv_vw2 in uv_vw2])
-        vw1_bridge = np.min([np.abs(np.pi - one_uv_vw1) + np.abs(np.pi / 2.0 - one_uv_vw2) +
-                             np.abs(np.pi / 2.0 - one_w1v_vw2) for one_uv_vw1 in uv_vw1
-                             for one_uv_vw2 in uv_vw2 for one_w1v_vw2 in w1v_vw2])
-        vw2_bridge = np.min([np.abs(np.pi - one_uv_vw2) + np.abs(np.pi / 2.0 - one_uv_vw1) +
-                             np.abs(np.pi / 2.0 - one_w1v_vw2) for one_uv_vw2 in uv_vw2
-                             for one_uv_vw1 in uv_vw1 for one_w1v_vw2 in w1v_vw2])
+        combinations.append((w1, w2))
+        for one_u, one_w1 in it.product([u, in_u], [w1, in_w1]):
+            triples.append((one_u, v, one_w1))
+        for one_u, one_w2 in it.product([u, in_u], [w2, in_w2]):
+            triples.append((one_u, v, one_w2))
+        for one_w1, one_w2 in it.product([w1, in_w1], [w2, in_w2]):
+            triples.append((one_w1, v, one_w2))
+    if not combinations:
+        return
+
+    # all angles of the junction in one batch, for each combination 4 of u,v v,w1 - 4 of u,v v,w2 - 4 of w1,v v,w2
+    angles = calculate_abs_angles(triples).reshape((-1, 3, 4))
+    # each term of a bridge score depends on one angle only, so the minimal score is the sum of minimal terms
+    straight = np.min(np.abs(np.pi - angles), axis=2)
+    right = np.min(np.abs(np.pi / 2.0 - angles), axis=2)
+    uv_bridges = straight[:, 2] + right[:, 0] + right[:, 1]
+    vw1_bridges = straight[:, 0] + right[:, 1] + right[:, 2]
+    vw2_bridges = straight[:, 1] + right[:, 0] + right[:, 2]
+    for (w1, w2), uv_bridge, vw1_bridge, vw2_bridge in zip(combinations, uv_bridges, vw1_bridges, vw2_bridges):
         t_scores[(u, v, w1, w2)] = [(u, v, uv_bridge), (v, w1, vw1_bridge), (v, w2, vw2_bridge)]
 
 
@@ -1085,58 +1247,50 @@ def calculate_junctions_t_scores(edge_dictionary, excluded):
 # calculate minimum l_score for each vertex
 def calculate_junctions_l_scores(edge_dictionary, vertexes, excluded, max_dist=7):
     vertexes_l_scores = dict()
+    # per page memo of |pi - angle| for directed (z, w, v) triples, the angle at w between its edges to z and v
+    # the z term of (z, w, v) at vertex v is also the w1,w2 term of the pair z, v at vertex w
+    angle_cache = dict()
+    lookups = 0
+    hits = 0
     for vertex in vertexes:
         if vertex in excluded:
             continue
-        # get list of edges that that vertex is part of
-        edges_of_vertex = [e for e in edge_dictionary.keys() if e[0] == vertex or e[1] == vertex]
-        junction_l_scores = dict()
-        junctions = []
-        l_scores = []
-        for combination in it.combinations(edges_of_vertex, 2):
-            e1, e2 = combination
-            e1_e1, e1_e2 = e1
-            e2_e1, e2_e2 = e2
-            if e1_e1 in excluded or e1_e2 in excluded or e2_e1 in excluded or e2_e2 in excluded:
+        # the w1 and w2 terms are independent, so each neighbor w is scored once by its best edge (w, z)
+        z_triples = dict()
+        for w in edge_dictionary.neighbors(vertex):
+            if w in excluded:
                 continue
-            w1 = e1[0] if e1[0] != vertex else e1[1]
-            w2 = e2[0] if e2[0] != vertex else e2[1]
+            z_triples[w] = [(z, w, vertex) for z in edge_dictionary.neighbors(w) if z != vertex and z not in excluded]
+        junctions = [(w1, vertex, w2) for w1, w2 in it.combinations(z_triples, 2) if z_triples[w1] and z_triples[w2]]
+        if not junctions:
+            continue
 
+        # angles missing from the cache are calculated in one batch
+        triples = junctions + [triple for w in set(w for w1, _, w2 in junctions for w in [w1, w2])
+                               for triple in z_triples[w]]
+        missing = [triple for triple in triples if triple not in angle_cache]
+        lookups += len(triples)
+        hits += len(triples) - len(missing)
+        if missing:
             # get coordinates in radius 9 - then calculate angle
-            in_w1, in_w2 = get_nearby_pixels_two_edges(vertex, w1, w2, edge_dictionary, max_dist=max_dist)
-
-            angle_w1v_vw2 = calculate_abs_angle(in_w1, vertex, in_w2)
-
-            edges_of_w1 = [e for e in edge_dictionary.keys() if e[0] == w1 and e[1] != vertex
-                           or e[1] == w1 and e[0] != vertex]
-            edges_of_w2 = [e for e in edge_dictionary.keys() if e[0] == w2 and e[1] != vertex
-                           or e[1] == w2 and e[0] != vertex]
-            for edge_of_w1 in edges_of_w1:
-                w1_e1, w1_e2 = edge_of_w1
-                if w1_e1 in excluded or w1_e2 in excluded:
-                    continue
-                z1 = edge_of_w1[0] if edge_of_w1[0] != w1 else edge_of_w1[1]
-                in_v, in_z1 = get_nearby_pixels_two_edges(w1, vertex, z1, edge_dictionary, max_dist=max_dist)
-                angle_z1w1_w1v = calculate_abs_angle(in_z1, w1, in_v)
-                for edge_of_w2 in edges_of_w2:
-                    w2_e1, w2_e2 = edge_of_w2
-                    if w2_e1 in excluded or w2_e2 in excluded:
-                        continue
-                    z2 = edge_of_w2[0] if edge_of_w2[0] != w2 else edge_of_w2[1]
-                    in_v, in_z2 = get_nearby_pixels_two_edges(w2, vertex, z2, edge_dictionary, max_dist=max_dist)
-                    angle_z2w2_w2v = calculate_abs_angle(in_z2, w2, in_v)
-                    junctions.append((z1, w1, vertex, w2, z2))
-
-                    l_scores.append(np.abs(np.pi - angle_w1v_vw2) * 0.5 +
-                                    np.abs(np.pi - angle_z1w1_w1v) * 0.25 +
-                                    np.abs(np.pi - angle_z2w2_w2v) * 0.25)
-                    junction_l_scores[(z1, w1, vertex, w2, z2)] = np.abs(np.pi - angle_w1v_vw2) * 0.5 + \
-                                                                  np.abs(np.pi - angle_z1w1_w1v) * 0.25 + \
-                                                                  np.abs(np.pi - angle_z2w2_w2v) * 0.25
-
-        if l_scores:
-            min_score = np.min(l_scores)
-            vertexes_l_scores[vertex] = min_score
+            angles = np.abs(np.pi - calculate_abs_angles([(edge_dictionary.direction(w, z, max_dist), w,
+                                                            edge_dictionary.direction(w, v, max_dist))
+                                                           for z, w, v in missing]))
+            for (z, w, v), angle in zip(missing, angles):
+                angle_cache[(z, w, v)] = angle
+                angle_cache[(v, w, z)] = angle
+
+        # l score of the best (z1, w1, vertex, w2, z2) of each w1, w2
+        min_z_angle = dict()
+        for w1, _, w2 in junctions:
+            for w in [w1, w2]:
+                if w not in min_z_angle:
+                    min_z_angle[w] = np.min([angle_cache[triple] for triple in z_triples[w]])
+        l_scores = [angle_cache[junction] * 0.5 + min_z_angle[junction[0]] * 0.25 + min_z_angle[junction[2]] * 0.25
+                    for junction in junctions]
+        vertexes_l_scores[vertex] = np.min(l_scores)
+    time_print('l scores angle cache: hits= ' + str(hits) + ' lookups= ' + str(lookups) +
+               ' hit rate= ' + str(round(100.0 * hits / max(lookups, 1), 1)) + '%')
     return vertexes_l_scores
 
 # ---------------------------------------------------------------------------------
@@ -1150,7 +1304,7 @@ def overlay_and_save(bridges, links, rest, edge_dictionary, image_preprocessed,
     image = draw_edges(links, edge_dictionary, image, (0, 255, 0))
     # rest = [x for x in edge_dictionary.keys() if x not in set(bridges).union(links)]
     image = draw_edges(rest, edge_dictionary, image, (0, 0, 255))
-    cv2.imwrite('./' + file_name + '/overlayed_classifications_' + score_type + '.png', image)
+    artifact_writer.write('./' + file_name + '/overlayed_classifications_' + score_type + '.png', image, 'stages')
 
     return image
 
@@ -1161,29 +1315,22 @@ def overlay_and_save(bridges, links, rest, edge_dictionary, image_preprocessed,
 def greedy_classification(t_scores, edge_dictionary, skeleton, file_name, score_type, image_offset_values):
     bridges = set()
     links = set()
-    use_later = set()
+    # priority queue of junctions keyed by their score, ties are resolved by junction order.
+    # the score of a junction is the score of its first (u, v) entry - the same entry
+    # np.argmin(map(...)) picked, as it always returned index 0
+    junctions_queue = [(scores[0][2], index, key) for index, (key, scores) in enumerate(t_scores.items())]
+    heapq.heapify(junctions_queue)
     index = 1
-    while t_scores:
+    while junctions_queue:
         if index % 500 == 0:
-            time_print(len(t_scores))
+            time_print(len(junctions_queue))
 
         index += 1
-        # find minimum score for each junction
-        min_t_scores = dict()
-        for key in t_scores.keys():
-            min_score_index = np.argmin(map(lambda e_1, e_2, score: score, t_scores[key]))
-            min_t_scores[key] = t_scores[key][min_score_index]
-
         # find junction with minimum score of all junctions
-        values = [value[2] for value in min_t_scores.values()]
-        min_score_index = np.argmin(values)
-        min_score_key = list(min_t_scores.keys())[min_score_index]
-        min_score = min_t_scores[min_score_key]
+        _, _, min_score_key = heapq.heappop(junctions_queue)
+        min_score = t_scores[min_score_key][0]
         # add to bridges - CHECK FOR CONFLICT
-        new_bridge = (min_score[0], min_score[1])
-        if new_bridge not in edge_dictionary.keys():
-            p1, p2 = new_bridge
-            new_bridge = (p2, p1)
+        new_bridge = edge_dictionary.key(min_score[0], min_score[1])
 
         # add to links - CHECK FOR CONFLICT
         two_links = [item for item in t_scores[min_score_key] if item is not min_score]
@@ -1192,10 +1339,7 @@ def greedy_classification(t_scores, edge_dictionary, skeleton, file_name, score_
             bridges.add(new_bridge)
             for link in two_links:
                 e1, e2, _ = link
-                new_link = (e1, e2)
-                if new_link not in edge_dictionary.keys():
-                    new_link = (e2, e1)
-                links.add(new_link)
+                links.add(edge_dictionary.key(e1, e2))
         # check for conflicts before adding them??
         # add new bridge to bridges set
         # remove minimum t score junction from t_scores
@@ -1203,23 +1347,23 @@ def greedy_classification(t_scores, edge_dictionary, skeleton, file_name, score_
     skeleton = skeleton.astype(np.uint8)
 
     # find anchor edges
-    anchors = [x for x in edge_dictionary.keys() if x not in set(bridges).union(links)]
+    anchors = [x for x in edge_dictionary.keys() if x not in bridges and x not in links]
 
     # mark edges connected to anchor points as conflict edges
+    anchor_coords = set(coord for edge in anchors for coord in edge)
     for bridge in bridges:
-        for coord in [coord for edge in anchors for coord in edge]:
-            if coord in bridge:
-                links.add(bridge)
-                break
+        if bridge[0] in anchor_coords or bridge[1] in anchor_coords:
+            links.add(bridge)
 
     # draw_graph_edges(edge_dictionary, skeleton, 'before')
-    image = cv2.cvtColor(np.zeros_like(skeleton), cv2.COLOR_GRAY2RGB)
-    image = draw_edges(bridges, edge_dictionary, image, (255, 0, 0))
-    image = draw_edges(links, edge_dictionary, image, (0, 255, 0))
-    image = draw_edges(anchors, edge_dictionary, image, (0, 0, 255))
+    if artifact_writer.writes('stages'):
+        image = cv2.cvtColor(np.zeros_like(skeleton), cv2.COLOR_GRAY2RGB)
+        image = draw_edges(bridges, edge_dictionary, image, (255, 0, 0))
+        image = draw_edges(links, edge_dictionary, image, (0, 255, 0))
+        image = draw_edges(anchors, edge_dictionary, image, (0, 0, 255))
 
-    cv2.imwrite('./' + file_name + '/classifications_' + score_type + '.png', image)
-    cv2.imwrite('./' + file_name + '/classifications_' + score_type + '_inverted.png', 255 - image)
+        artifact_writer.write('./' + file_name + '/classifications_' + score_type + '.png', image, 'stages',
+                              inverted=True)
 
     return bridges, links, anchors, edge_dictionary
 
@@ -1258,45 +1402,79 @@ def create_v_scores(t_scores, l_scores):
 #
 def combine_edges(bridges, links, rest, edge_dictionary):
     def merge_group(candidate_edges, edge_dict, adj_list, anchors, threshold=np.pi / 5):
+        # best neighbor of link (u,v) - the link through v with highest angle, the first one in list order on ties
+        # links reaching an anchor point get no entry, a new entry is pushed on the heap and older ones go stale
+        def push_best_neighbor(index):
+            u, v = links[index]
+            neighbors = [links[i] for i in sorted(links_of_vertex[v]) if u not in links[i]]
+            real_neighbors = [e if e not in adj_list.keys() else adj_list[e] for e in neighbors]
+            entries.pop(index, None)
+            if real_neighbors:
+                angles = calculate_abs_angles([(u, v, e[0] if e[1] == v else e[1]) for e in real_neighbors])
+                max_index = np.argmax(angles)
+                max_neighbor = real_neighbors[max_index]
+                # if we reached anchor points we skip
+                if any(coord in anchor_coords and coord in max_neighbor for coord in links[index]):
+                    return
+                entries[index] = next(entry_count)
+                heapq.heappush(merge_queue, (-angles[max_index], index, entries[index], max_neighbor))
+
+        def add_link(link):
+            index = next(link_count)
+            links[index] = link
+            for coord in link:
+                links_of_vertex.setdefault(coord, set()).add(index)
+            return index
+
+        def remove_link(link):
+            for index in set(i for i in links_of_vertex.get(link[0], ()) if links[i] == link):
+                del links[index]
+                entries.pop(index, None)
+                for coord in link:
+                    links_of_vertex[coord].discard(index)
+
+        anchor_coords = set(coord for e in anchors for coord in e)
+        # candidate links by their index in list order, new links go last
+        link_count = it.count()
+        links = dict()
+        links_of_vertex = dict()
+        for link in candidate_edges:
+            add_link(link)
+        # max-heap of the best merge of each link keyed by angle, ties are resolved by list order
+        entry_count = it.count()
+        entries = dict()
+        merge_queue = []
+        for index in list(links.keys()):
+            push_best_neighbor(index)
+
         # we combine two links as one if angle between them is minimum
-        done = False
-        while not done:
-            done = True
-            merge_link_1 = []
-            merge_link_2 = []
-            merge_angles = 0
-            # in find the 'best' two links for merge - those that have highest angle of all
-            for link in candidate_edges:
-                u, v = link
-                neighbors = [l for l in candidate_edges if v in l and u not in l]
-                real_neighbors = [e if e not in adj_list.keys() else adj_list[e] for e in neighbors]
-                if real_neighbors:
-                    angles = [calculate_abs_angle(u, v, e[0] if e[1] == v else e[1]) for e in real_neighbors]
-                    max_index = np.argmax(angles)
-                    max_neighbor = real_neighbors[max_index]
-                    is_anchor = False
-                    # if we reached anchor points we skip
-                    for coord in [coord for e in anchors for coord in e]:
-                        if coord in link and coord in max_neighbor:
-                            is_anchor = True
-                            break
-                    if not is_anchor and angles[max_index] > merge_angles:
-                        merge_angles = angles[max_index]
-                        merge_link_1 = link
-                        merge_link_2 = max_neighbor
+        while merge_queue:
+            negative_angle, index, entry, merge_link_2 = heapq.heappop(merge_queue)
+            if entries.get(index) != entry:
+                continue
+            # the 'best' two links for merge - those that have highest angle of all
+            if np.abs(np.pi + negative_angle) >= threshold:
+                break
 
             # now we merge 'best' candidates together modifying the document graph
-            if merge_link_1 and np.abs(np.pi - merge_angles) < threshold:
-
-                done = False
-                pixels_1 = edge_dict.pop(merge_link_1)
-                pixels_2 = edge_dict.pop(merge_link_2)
-                new_edge = (merge_link_1[0], merge_link_2[0] if merge_link_2[0] != merge_link_1[1] else merge_link_2[1])
-                edge_dict[new_edge] = list(set(pixels_1 + pixels_2))
-                candidate_edges = [e for e in candidate_edges if e != merge_link_1 and e != merge_link_2]
-                candidate_edges.append(new_edge)
-
-        return candidate_edges, edge_dict, adj_list
+            merge_link_1 = links[index]
+            new_edge = (merge_link_1[0], merge_link_2[0] if merge_link_2[0] != merge_link_1[1] else merge_link_2[1])
+            # the graph holds one edge per vertex pair, links whose ends are already joined are left apart
+            if edge_dict.key(*new_edge) is not None:
+                continue
+            pixels_1 = edge_dict.pop(merge_link_1)
+            pixels_2 = edge_dict.pop((merge_link_1[1], new_edge[1]))
+            edge_dict[new_edge] = concatenate_paths(pixels_1, pixels_2)
+            remove_link(merge_link_1)
+            remove_link(merge_link_2)
+            add_link(new_edge)
+            # only links through the merged vertexes have new neighbors
+            merged = set(merge_link_1 + new_edge)
+            for i in sorted(set(i for coord in merged for i in links_of_vertex.get(coord, ()))):
+                if links[i][1] in merged:
+                    push_best_neighbor(i)
+
+        return list(links.values()), edge_dict, adj_list
 
     can_be_both = [e for e in links if e in bridges]
     # bridges = [e for e in bridges if e not in can_be_both]
@@ -1319,7 +1497,8 @@ def combine_edges(bridges, links, rest, edge_dictionary):
                                                         threshold=np.pi / 6)
 
     # remove bridges from document graph that were not used in conflict stage
-    only_bridges = [bridge for bridge in bridges if bridge in edge_dictionary.keys()]
+    # a merged edge may join the two ends of a removed bridge, it is told apart by its key orientation
+    only_bridges = [bridge for bridge in bridges if edge_dictionary.key(*bridge) == bridge]
     bridges_dict = dict()
     for bridge in only_bridges:
         bridges_dict[bridge] = edge_dictionary.pop(bridge)
@@ -1330,91 +1509,117 @@ def combine_edges(bridges, links, rest, edge_dictionary):
 # ---------------------------------------------------------------------------------
 # finalize_graph - remove wrong direction edges - and combine edges of two degree vertexes
 # text_angle is text direction relative to x axis
+# bridges removed by combine_edges (only_bridges) are added back only when add_back_bridges is set
+# disconnected edges are connected only when connect_disconnected is set
 #
-def finalize_graph(combined_graph, only_bridges, anchors, threshold=np.pi / 4):
-    def calc_angle(edge):
-        u_e, v_e = edge
-        delta_x = v_e[0] - u_e[0]
-        delta_y = v_e[1] - u_e[1]
-        angle = np.arctan2(delta_y, delta_x)
-        return np.abs(angle)
-
+def finalize_graph(combined_graph, only_bridges, anchors, threshold=np.pi / 4, add_back_bridges=False,
+                   connect_disconnected=False):
     anchors = [(anchor[1], anchor[0]) for anchor in anchors]
-    anchor_edges = [edge for edge in combined_graph.keys() if edge[0] in anchors or edge[1] in anchors]
+    anchor_edges = [edge for anchor in anchors for edge in combined_graph.incident(anchor)]
 
     # flat_anchors = [tuple(val) for sublist in anchor_edges for val in sublist]
     # remove edges that their angle is not within text_angle threshold
     # remove_candidates = [edge for edge in combined_graph.keys() if edge[0] not in flat_anchors
-    #                     and edge[1] not in flat_anchors and calc_angle(edge) < threshold]
-    remove_candidates = [edge for edge in combined_graph.keys() if calc_angle(edge) < threshold]
+    #                     and edge[1] not in flat_anchors and combined_graph.orientation(edge) < threshold]
+    remove_candidates = [edge for edge in combined_graph.keys() if combined_graph.orientation(edge) < threshold]
     for candidate in set(remove_candidates + anchor_edges):
         combined_graph.pop(candidate)
 
-    # merge two degree vertexes
-    done = False
-    while not done:
-        all_vertexes = [coord for edge in combined_graph.keys() for coord in edge]
-        vertexes = list(set(all_vertexes))
-        done = True
-        for vertex in vertexes:
-            two_links = [link for link in combined_graph.keys() if vertex in link]
-            if len(two_links) == 2:
-                link_1, link_2 = two_links
-                if link_1[0] == link_2[0]:
-                    u = link_1[1]
-                    w = link_2[1]
-                    v = link_1[0]
-                elif link_1[0] == link_2[1]:
-                    u = link_1[1]
-                    w = link_2[0]
-                    v = link_1[0]
-                elif link_1[1] == link_2[0]:
-                    u = link_1[0]
-                    w = link_2[1]
-                    v = link_1[1]
-                else:
-                    u = link_1[0]
-                    w = link_2[0]
-                    v = link_1[1]
-                new_edge = (u, w)
-                if np.abs(np.pi - calculate_abs_angle(u, v, w)) < threshold:
-                    pixels_1 = combined_graph.pop(link_1)
-                    pixels_2 = combined_graph.pop(link_2)
-                    combined_graph[new_edge] = list(set(pixels_1 + pixels_2))
-                    done = False
-                    break
-
-    all_vertexes = [coord for edge in combined_graph.keys() for coord in edge]
-    vertexes = list(set(all_vertexes))
-
-    done = True
-    while not done:
-        done = True
+    # merge two degree vertexes, a merge changes the edges of its two ends so they are checked again
+    worklist = col.deque(vertex for vertex in combined_graph.vertexes() if combined_graph.degree(vertex) == 2)
+    while worklist:
+        v = worklist.popleft()
+        if combined_graph.degree(v) == 2:
+            u, w = combined_graph.neighbors(v)
+            new_edge = (u, w)
+            # u and w may already be joined by another edge, then v is kept
+            if combined_graph.key(u, w) is None and np.abs(np.pi - calculate_abs_angle(u, v, w)) < threshold:
+                pixels_1 = combined_graph.pop((u, v))
+                pixels_2 = combined_graph.pop((v, w))
+                combined_graph[new_edge] = concatenate_paths(pixels_1, pixels_2)
+                worklist.extend([u, w])
+
+    # add back bridges whose both ends are left with one edge, joining the two edges through the bridge
+    # adding back a bridge only leaves its own ends without edges, so one pass over the bridges is enough
+    if add_back_bridges:
         for bridge in only_bridges.keys():
             v, w = bridge
-            # print('v=', v, 'w=', w)
-            link_1 = [link for link in combined_graph.keys() if v in link]
-            link_2 = [link for link in combined_graph.keys() if w in link]
-            # print('link_1=', link_1)
-            # print('link_2=', link_2)
-            if len(link_1) == 1 and len(link_2) == 1:
-                # print('adding back bridge!!')
-                pixels_1 = combined_graph.pop(link_1[0])
-                pixels_2 = combined_graph.pop(link_2[0])
+            if combined_graph.degree(v) == 1 and combined_graph.degree(w) == 1:
+                new_edge = (combined_graph.neighbors(v)[0], combined_graph.neighbors(w)[0])
+                # the ends of the bridge may lead to one vertex or to two vertexes that are already joined
+                if new_edge[0] == new_edge[1] or combined_graph.key(*new_edge) is not None:
+                    continue
+                pixels_1 = combined_graph.pop((new_edge[0], v))
+                pixels_2 = combined_graph.pop((w, new_edge[1]))
                 pixels_3 = only_bridges[bridge]
-                new_edge = (link_1[0][0] if link_1[0][0] != v else link_1[0][1],
-                            link_2[0][0] if link_2[0][0] != w else link_2[0][1])
-                combined_graph[new_edge] = list(set(pixels_1 + pixels_2 + pixels_3))
-                done = False
-                break
+                combined_graph[new_edge] = concatenate_paths(pixels_1, pixels_3, pixels_2)
+
+    if connect_disconnected:
+        combined_graph = connect_disconnected_edges(combined_graph)
 
     return combined_graph
 
 
+# ---------------------------------------------------------------------------------
+# connect disconnected edges - each end of an edge is joined by a straight line to the closest end of
+# another edge within max_range pixels, if the line goes on in the edge direction (angle above pi / 2)
+# and does not run back along the edge (less than 10 rows shared with it)
+# edge ends are kept in a KD-tree, so each end only meets the edges around it
+def connect_disconnected_edges(graph, max_range=60):
+    edges = list(graph.keys())
+    if len(edges) < 2:
+        return graph
+    ends = np.asarray(edges, np.float64).reshape((-1, 2, 2))
+    ends_tree = cKDTree(ends.reshape((-1, 2)))
+    near_ends = ends_tree.query_ball_point(ends.reshape((-1, 2)), max_range)
+
+    new_edges = dict()
+    for index, edge in enumerate(edges):
+        u, v = edge
+        neighbors = sorted(set(i // 2 for i in near_ends[2 * index] + near_ends[2 * index + 1]))
+        neighbors = [i for i in neighbors if u not in edges[i] and v not in edges[i]]
+        if not neighbors:
+            continue
+        # distances u,w1 u,w2 v,w1 v,w2 - each neighbor is only joined by its closest ends
+        distances = np.sqrt(np.sum((ends[index][None, :, None] - ends[neighbors][:, None, :]) ** 2, axis=3))
+        distances = distances.reshape((-1, 4))
+        closest = np.argmin(distances, axis=1)
+        closest_distance = distances[np.arange(len(neighbors)), closest]
+        edge_end, neighbor_end = closest // 2, closest % 2
+        angles = calculate_abs_angles([(edge[1 - e], edge[e], edges[i][w])
+                                       for e, i, w in zip(edge_end, neighbors, neighbor_end)])
+        for e in [0, 1]:
+            candidates = (edge_end == e) & (np.pi / 2 < angles)
+            if not np.any(candidates):
+                continue
+            best = np.argmin(np.where(candidates, closest_distance, np.inf))
+            start, end = edge[e], edges[neighbors[best]][neighbor_end[best]]
+            rows, cols = draw.line(int(start[0]), int(start[1]), int(end[0]), int(end[1]))
+            # ends that are already joined keep their edge
+            if graph.key(start, end) is None and len(np.intersect1d(rows, graph[edge][:, 0])) < 10:
+                new_edges[(start, end)] = np.stack([rows, cols], axis=1)
+
+    for edge in new_edges.keys():
+        graph[edge] = new_edges[edge]
+    return graph
+
+
 # ---------------------------------------------------------------------------------
 # main execution function
+# artifact_level is one of ArtifactWriter.levels, inverted_artifacts adds an inverted copy to the images that have one
+# images are written by writer_threads threads in the background, 0 writes them on the spot
+# clustering is the engine of the component clustering in pre processing, see cluster_values
+# plots of the touching line fits are rendered only for the components given to fit_diagnostics.set_components
+# fit_workers processes fit the touching line gaussians, 0 fits them in this process
+# add_back_bridges and connect_disconnected are passed on to finalize_graph
 #
-def execute(input_path, output_path):
+def execute(input_path, output_path, artifact_level='all', inverted_artifacts=True, writer_threads=2,
+            clustering='gmm', fit_workers=0, add_back_bridges=False, connect_disconnected=False):
+    artifact_writer.set_level(artifact_level, inverted_artifacts)
+    artifact_writer.set_workers(writer_threads)
+    # the writer threads are running by the first fit, so the fit workers are spawned instead of forked
+    fit_executor = ProcessPoolExecutor(max_workers=fit_workers, mp_context=multiprocessing.get_context('spawn')) \
+        if fit_workers > 0 else None
     # retrieve list of images
     images = [f for f in listdir(input_path) if isfile(join(input_path, f))]
     i = 1
@@ -1429,7 +1634,9 @@ def execute(input_path, output_path):
 
         # pre-process image
         time_print('pre-process image...')
-        image_view, image_preprocessed, anchors, image_offset_values = pre_process(input_path + image, file_name)
+        image_view, image_preprocessed, anchors, image_offset_values = pre_process(input_path + image, file_name,
+                                                                                  clustering=clustering,
+                                                                                  executor=fit_executor)
         # create dir for results
 
         # extract ridges
@@ -1462,16 +1669,28 @@ def execute(input_path, output_path):
 
         time_print('finalizing document graph ...')
 
-        finalized_combined_graph = finalize_graph(combined_graph, use_later, anchors)
+        finalized_combined_graph = finalize_graph(combined_graph, use_later, anchors,
+                                                  add_back_bridges=add_back_bridges,
+                                                  connect_disconnected=connect_disconnected)
 
         name = draw_graph_edges(finalized_combined_graph, res_finalization, file_name, wait_flag=False, overlay=True,
-                                image_offset_values=image_offset_values, file_name='final_result_finalize')
+                                image_offset_values=image_offset_values, file_name='final_result_finalize',
+                                level='final')
 
         time_print('SAVED: ' + str(name))
         i += 1
 
+    if fit_executor is not None:
+        fit_executor.shutdown()
+    failures = artifact_writer.flush()
+    time_print('all images written, ' + str(len(failures)) + ' failed')
+
 
-def process_image_parallel(image_data, len_images, input_path, output_path):
+def process_image_parallel(image_data, len_images, input_path, output_path, artifact_level='all',
+                           inverted_artifacts=True, writer_threads=2, clustering='gmm', add_back_bridges=False,
+                           connect_disconnected=False):
+    artifact_writer.set_level(artifact_level, inverted_artifacts)
+    artifact_writer.set_workers(writer_threads)
     i, image = image_data
     idx_str = '[' + str(i) + '/' + str(len_images) + '] '
     file_name = image.split('.')[0]
@@ -1483,7 +1702,8 @@ def process_image_parallel(image_data, len_images, input_path, output_path):
 
     # pre-process image
     time_print(idx_str + 'pre-process image...')
-    image_view, image_preprocessed, anchors, image_offset_values = pre_process(input_path + image, file_name, idx_str)
+    image_view, image_preprocessed, anchors, image_offset_values = pre_process(input_path + image, file_name, idx_str,
+                                                                              clustering)
     # create dir for results
     # extract ridges
     time_print('[' + str(i) + '/' + str(len_images) + '] extract ridges, junctions...')
@@ -1518,22 +1738,28 @@ def process_image_parallel(image_data, len_images, input_path, output_path):
     draw_graph_edges(combined_graph, res_no_finalization, file_name, wait_flag=False, overlay=True,
                      image_offset_values=image_offset_values, file_name='final_result_no_finalize')
     time_print(idx_str + 'finalizing document graph ...')
-    finalized_combined_graph = finalize_graph(combined_graph, use_later, anchors)
+    finalized_combined_graph = finalize_graph(combined_graph, use_later, anchors, add_back_bridges=add_back_bridges,
+                                              connect_disconnected=connect_disconnected)
 
     name = draw_graph_edges(finalized_combined_graph, res_finalization, file_name, wait_flag=False, overlay=True,
-                            image_offset_values=image_offset_values, file_name='final_result_finalize')
-    time_print('SAVED: ' + str(name))
+                            image_offset_values=image_offset_values, file_name='final_result_finalize',
+                            level='final')
+    failures = artifact_writer.flush()
+    time_print('SAVED: ' + str(name) + ', ' + str(len(failures)) + ' images failed')
     return i
 
 # ---------------------------------------------------------------------------------
 # main execution function - parallel version
 #
-def execute_parallel(input_path, output_path):
+def execute_parallel(input_path, output_path, artifact_level='all', inverted_artifacts=True, writer_threads=2,
+                     clustering='gmm', add_back_bridges=False, connect_disconnected=False):
     # retrieve list of images
     images = [f for f in listdir(input_path) if isfile(join(input_path, f))]
 
     pool = ProcessPoolExecutor(max_workers=4)
-    wait_for = [pool.submit(process_image_parallel, image, len(images), input_path, output_path) for image in zip(range(1, len(images)), images)]
+    wait_for = [pool.submit(process_image_parallel, image, len(images), input_path, output_path, artifact_level,
+                            inverted_artifacts, writer_threads, clustering, add_back_bridges, connect_disconnected)
+                for image in zip(range(1, len(images)), images)]
     # results = [f.result() for f in futures.as_completed(wait_for)]
     i = 0
     total = len(images)
@@ -15,6 +15,7 @@ import collections as col
 
 from skan import csr
 from os import listdir
+from scipy import special
 from scipy import optimize
 from scipy import integrate as intg
 from skimage import morphology
@@ -162,6 +163,87 @@ def draw_graph_edges(edge_dictionary, ridges_mask, window_name, wait_flag=False,
     return name
 
 
+# ---------------------------------------------------------------------------------
+# gaussian with mean mu, standard deviation sigma and height A
+def gauss(x_value, mu, sigma, A):
+    return A * pylab.exp(-(x_value - mu) ** 2 / 2 / sigma ** 2)
+
+
+# ---------------------------------------------------------------------------------
+# integral of gauss over [low, high]
+def gauss_mass(mu, sigma, A, low, high):
+    scale = np.sqrt(2) * np.abs(sigma)
+    return A * np.abs(sigma) * np.sqrt(np.pi / 2) * (special.erf((high - mu) / scale) -
+                                                      special.erf((low - mu) / scale))
+
+
+# ---------------------------------------------------------------------------------
+# multi threshold sweep - fits n gaussians for every n in ns and every overlap threshold in thresholds (increasing)
+# window i of n is the i-th of n equal pieces of hist grown by int32(thresh * piece) on each side, the first and
+# last windows run to the histogram ends. thresholds that give the same overlap give the same fit, so each
+# overlap is fitted once. every fit starts from the curve_fit defaults, as one get_n_cut_valleys(hist, n, thresh)
+# call did, so a fitted overlap gives the same gaussians as that call. overlaps are swept from the threshold
+# closest to 0 outwards, once a fit worked each side stops after patience overlaps that do not improve the
+# error, patience None sweeps the whole grid
+# returns {n: (params_n, good_n)} - the best (mu, sigma, A) of each gaussian over the thresholds, mu shifted to
+# hist coordinates, and its error, the mass of the gaussian outside the histogram. good_n is inf if no fit worked
+def sweep_n_cut_valleys(hist, ns, thresholds, patience=2):
+    hist = np.asarray(hist, np.float64)
+    x_s = np.arange(len(hist))
+
+    def windows(n, overlap):
+        piece = math.floor(len(hist) / n)
+        starts = [0] + [i_dx * piece - overlap for i_dx in range(1, n)]
+        stops = [(i_dx + 1) * piece + overlap for i_dx in range(0, n - 1)] + [len(hist)]
+        return np.asarray(starts), np.minimum(stops, len(hist))
+
+    # fits every window, returns the window relative parameters or None
+    def fit(starts, stops):
+        try:
+            return np.asarray([optimize.curve_fit(gauss, x_s[:stop - start], hist[start: stop], method='trf')[0]
+                               for start, stop in zip(starts, stops)])
+        except (RuntimeError, ValueError):
+            return None
+
+    results = dict()
+    for n in ns:
+        piece = math.floor(len(hist) / n)
+        overlaps = [int(np.int32(thresh * piece)) for thresh in thresholds]
+        center = overlaps[int(np.argmin(np.abs(thresholds)))]
+        overlaps = sorted(set(overlaps))
+        center = overlaps.index(center)
+        shift = math.floor((len(hist) + 1) / n) * np.arange(n)
+        best_params = np.full((n, 3), np.nan)
+        best_errors = np.full(n, np.inf)
+
+        # fits (n, overlaps[k]), keeps the gaussians that beat the best so far
+        # returns whether the fit worked and whether any gaussian got better
+        def evaluate(k):
+            params = fit(*windows(n, overlaps[k]))
+            if params is None:
+                return False, False
+            mu_n, sigma_n, A_n = params[:, 0] + shift, params[:, 1], params[:, 2]
+            good_n = np.abs(gauss_mass(mu_n, sigma_n, A_n, 0, len(hist)) -
+                            gauss_mass(mu_n, sigma_n, A_n, -np.inf, np.inf))
+            better = good_n < best_errors
+            best_errors[better] = good_n[better]
+            best_params[better] = np.stack((mu_n, sigma_n, A_n), axis=1)[better]
+            return True, bool(np.any(better))
+
+        fitted, _ = evaluate(center)
+        for side in (range(center + 1, len(overlaps)), range(center - 1, -1, -1)):
+            stale = 0
+            for k in side:
+                worked, improved = evaluate(k)
+                fitted = fitted or worked
+                # overlaps are only counted once a fit worked, failed fits before it say nothing about the error
+                stale = 0 if improved or not fitted else stale + 1
+                if patience is not None and stale >= patience:
+                    break
+        results[n] = (best_params, best_errors)
+    return results
+
+
 # ---------------------------------------------------------------------------------
 # split touching lines. find mean line width in image
 # find connected components
@@ -192,65 +274,6 @@ def split_touching_lines(image):
             #     result.append(np.int32(elem1))
         return result
 
-    def get_n_cut_valleys(hist, n, thresh):
-        # plt.clf()
-        # plt.plot(histogram, color='black', label='hist')
-        # plt.xlim([0, len(hist)])
-
-        # n Gaussians fitting attempt
-        try:
-            piece = math.floor(len(hist) / n)
-            y_n = list()
-            y_n.append(hist[0: piece + np.int32(thresh * piece)])
-            for i_dx in range(1, n - 1):
-                y_n.append(hist[i_dx * piece - np.int32(thresh * piece):
-                                 (i_dx + 1) * piece + np.int32(thresh * piece)])
-            y_n.append(hist[(n - 1) * piece - np.int32(thresh * piece):])
-
-            x_n = [[z for z in range(len(y_n[y_i_dx]))] for y_i_dx in range(0, len(y_n))]
-
-            params_errors_n = [optimize.curve_fit(gauss, x_i, y_i, method='trf') for x_i, y_i in zip(x_n, y_n)]
-            params_n = [elem[0] for elem in params_errors_n]
-        except RuntimeError as err:
-            # print('RuntimeError:', err)
-            # plt.clf()
-            return [None for l in range(n)], [np.inf for l in range(n)]
-        except ValueError as err:
-            # print('ValueError=', err)
-            return [None for l in range(n)], [np.inf for l in range(n)]
-
-        # append shift for mu_i
-        mu_n = [params_i[0] for params_i in params_n]
-        sigma_n = [params_i[1] for params_i in params_n]
-        A_n = [params_i[2] for params_i in params_n]
-        shift = math.floor((len(hist) + 1) / n)
-
-        mu_n = [mu_i + i_dx * shift for i_dx, mu_i in enumerate(mu_n)]
-        gauss_n = [ft.partial(gauss, mu=mu_i, sigma=sigma_i, A=A_i) for mu_i, sigma_i, A_i in
-                   zip(mu_n, sigma_n, A_n)]
-
-        good_n = [np.abs(intg.quad(gauss_i, 0, len(hist), args=())[0] - intg.quad(gauss_i, -np.inf, np.inf, args=())[0])
-                  for gauss_i in gauss_n]
-
-        # return fitting functions + their fitting error using integrals
-        # print('gauss_n=', gauss_n)
-        # print('good_n=', good_n)
-        return gauss_n, good_n
-        # plt.plot(x_s, gauss(x_s, mu1, sigma1, A1), color='green', lw=3, label='gauss1')
-        # plt.plot(x_s, gauss(x_s, mu2, sigma2, A2), color='blue', lw=3, label='gauss2')
-        # plt.plot(x_s, gauss(x_s, mu3, sigma3, A3), color='red', lw=3, label='gauss3')
-        # plt.plot(x_s, gauss(x_s, mu4, sigma4, A4), color='yellow', lw=3, label='gauss4')
-        # plt.plot(x_s, bimodal(x_s, mu1, sigma1, A1, mu2, sigma2, A2), color='red', lw=3, label='bi-modal')
-        # plt.legend()
-        # plt.show()
-        # plt.clf()
-        # print('x_s_1=', x_s_1)
-        # print('x_s_2=', x_s_2)
-        # print('x_s_3=', x_s_3)
-
-    def gauss(x_value, mu, sigma, A):
-        return A * pylab.exp(-(x_value - mu) ** 2 / 2 / sigma ** 2)
-
     def bimodal(x_value, mu_1, sigma_1, a_1, mu_2, sigma_2, a_2):
         return gauss(x_value, mu_1, sigma_1, a_1) + gauss(x_value, mu_2, sigma_2, a_2)
 
@@ -385,23 +408,13 @@ def split_touching_lines(image):
             thresholds = [0.01 * t for t in range(-5, 6)]
             min_candidate_xs = list()
             min_average_error = np.inf
-            for i in range(2, 10):
-                candidates_i = [get_n_cut_valleys(histogram, i, thresh) for thresh in thresholds]
-                # print('candidates_i', candidates_i)
-                candidate_xs_i = [elem[0] for elem in candidates_i]
-                candidate_xs_errors_i = [elem[1] for elem in candidates_i]
-                # print('candidate_xs_errors_i=', candidate_xs_errors_i)
-                maybe_xs = list()
-                maybe_xs_error_total = 0
-                for t in range(0, i):
-                    min_t_idx = np.argmin([elem[t] for elem in candidate_xs_errors_i])
-                    # print('t=', t, 'min_t_idx=', min_t_idx)
-                    min_gauss = candidate_xs_i[min_t_idx][t]
-                    maybe_xs.append(min_gauss)
-                    maybe_xs_error_total += candidate_xs_errors_i[min_t_idx][t]
-                if maybe_xs_error_total / len(maybe_xs) < min_average_error:
-                    min_candidate_xs = maybe_xs
-                    min_average_error = maybe_xs_error_total / len(maybe_xs)
+            # best gaussian of each position over the thresholds, for every n
+            for n, (params_n, good_n) in sweep_n_cut_valleys(histogram, range(2, 10), thresholds).items():
+                # print('n=', n, 'good_n=', good_n)
+                if np.sum(good_n) / n < min_average_error:
+                    min_candidate_xs = [ft.partial(gauss, mu=mu_i, sigma=sigma_i, A=A_i)
+                                        for mu_i, sigma_i, A_i in params_n]
+                    min_average_error = np.sum(good_n) / n
 
             # print('min_candidate_xs=', min_candidate_xs)
             # print('min_average_error=', min_average_error)
@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+
+from skimage import draw
+
+import line_detection as ld
+
+
+# ---------------------------------------------------------------------------------
+# pixels of the straight line from u to v
+def line(u, v):
+    rows, cols = draw.line(u[0], u[1], v[0], v[1])
+    return np.stack([rows, cols], axis=1)
+
+
+# ---------------------------------------------------------------------------------
+# a straight path u - v - w and a curved edge u - w next to it, through (15, 20)
+def parallel_paths():
+    u, v, w, arc = (10, 10), (10, 20), (10, 30), (15, 20)
+    graph = ld.DocumentGraph()
+    graph[(u, v)] = line(u, v)
+    graph[(v, w)] = line(v, w)
+    graph[(u, w)] = ld.concatenate_paths(line(u, arc), line(arc, w))
+    return graph, u, v, w
+
+
+def pixel_set(graph):
+    return set(map(tuple, np.concatenate([graph[edge] for edge in graph.keys()]).tolist()))
+
+
+def test_prune_graph_degrees_merges_paths_through_removed_spur():
+    # q joins p and r, the spur q - s is removed, then the two edges of q are merged
+    p, q, r, s = (10, 10), (12, 30), (10, 50), (20, 31)
+    graph = ld.DocumentGraph()
+    graph[(p, q)] = line(p, q)
+    graph[(r, q)] = line(r, q)
+    graph[(q, s)] = line(q, s)
+    excluded = dict()
+    ld.prune_graph_degrees(graph, ld.col.deque(graph.vertexes()), {p, r}, excluded)
+    assert list(graph.keys()) == [(p, r)]
+    assert set(excluded) == {p, r}
+    # the merged path is the two paths joined at q in raster order, it is not traced again
+    assert np.array_equal(graph[(p, r)], np.concatenate([line(p, q), line(r, q)[-2::-1]]))
+
+
+def test_prune_graph_keeps_junction_pixel_after_spur_removal():
+    # skeleton around a junction of a synthetic page, its five arms end at anchor points
+    path = os.path.join(os.path.dirname(__file__), 'data', 'spur_junction.txt')
+    with open(path) as data:
+        skeleton = np.asarray([[c == '#' for c in row.strip()] for row in data], bool)
+    skeleton = np.pad(skeleton, 10)
+    ends = [(10, 56), (13, 70), (41, 70), (43, 10), (70, 40)]
+    ld.artifact_writer.set_level('none')
+    skel, results, excluded = ld.prune_graph(skeleton, '', [(c, r) for r, c in ends], thin=True)
+    assert sorted(map(tuple, excluded)) == ends
+    # the graph is pruned without thinning the skeleton again, so the junction stays at (40, 40) where skan
+    # found it and the corner pixels (40, 39), (40, 40) are kept. re-skeletonising after every pruning round
+    # thinned both away and moved the junction to (41, 40)
+    assert sorted(results.keys()) == [((10, 56), (38, 58)), ((13, 70), (38, 61)), ((38, 58), (38, 61)),
+                                      ((38, 58), (40, 40)), ((38, 61), (41, 70)), ((40, 40), (43, 10)),
+                                      ((40, 40), (70, 40))]
+    assert skel[40, 40] and skel[40, 39]
+
+
+def test_merge_group_keeps_parallel_edge():
+    graph, u, v, w = parallel_paths()
+    pixels = pixel_set(graph)
+    arc = graph[(u, w)].copy()
+    only_bridges, combined, use_later = ld.combine_edges(set(), {(u, v), (v, w)}, [(u, w)], graph)
+    assert not only_bridges and not use_later
+    assert sorted(map(frozenset, combined.keys())) == sorted(map(frozenset, [(u, v), (v, w), (u, w)]))
+    assert np.array_equal(combined[(u, w)], arc)
+    assert pixel_set(combined) == pixels
+
+
+def test_finalize_graph_keeps_parallel_edge():
+    graph, u, v, w = parallel_paths()
+    arc = graph[(u, w)].copy()
+    finalized = ld.finalize_graph(graph, dict(), [(0, 0)])
+    assert len(finalized) == 3
+    assert np.array_equal(finalized[(u, w)], arc)
+    assert finalized.degree(v) == 2
+
+
+def test_finalize_graph_skips_bridge_closing_a_loop():
+    # both ends of the bridge v - w lead to n, adding it back would make an n - n edge
+    v, w, n = (10, 30), (10, 40), (2, 35)
+    graph = ld.DocumentGraph()
+    graph[(v, n)] = line(v, n)
+    graph[(w, n)] = line(w, n)
+    finalized = ld.finalize_graph(graph, {(v, w): line(v, w)}, [(0, 0)], add_back_bridges=True)
+    assert sorted(finalized.keys()) == [(v, n), (w, n)]
+
+
+def test_finalize_graph_skips_bridge_parallel_to_edge():
+    # the ends of the bridge v - w lead to a and b, which are already joined
+    v, w, a, b = (10, 30), (10, 40), (2, 25), (2, 45)
+    graph = ld.DocumentGraph()
+    graph[(v, a)] = line(v, a)
+    graph[(w, b)] = line(w, b)
+    graph[(a, b)] = line(a, b)
+    finalized = ld.finalize_graph(graph, {(v, w): line(v, w)}, [(0, 0)], add_back_bridges=True)
+    assert sorted(finalized.keys()) == [(a, b), (v, a), (w, b)]
+    assert np.array_equal(finalized[(a, b)], line(a, b))
+
+
+def test_combine_edges_keeps_merge_over_removed_bridge():
+    # the bridge u - w is taken out, the links u - v - w are merged into a new u - w edge in its place
+    u, v, w = (10, 10), (10, 20), (10, 30)
+    graph = ld.DocumentGraph()
+    graph[(w, u)] = ld.concatenate_paths(line(w, (15, 20)), line((15, 20), u))
+    graph[(u, v)] = line(u, v)
+    graph[(v, w)] = line(v, w)
+    only_bridges, combined, use_later = ld.combine_edges({(w, u)}, {(u, v), (v, w)}, [], graph)
+    assert list(use_later.keys()) == [(w, u)] and not only_bridges
+    assert list(combined.keys()) == [(u, w)]
+    assert np.array_equal(combined[(u, w)], line(u, w))
+
+
+def test_largest_component_is_8_connected():
+    mask = np.zeros((12, 12), np.uint8)
+    # a diagonal of 6 pixels is one 8 connected component, the 2x2 block is smaller
+    mask[np.arange(6), np.arange(6)] = 1
+    mask[8:10, 8:10] = 1
+    expected = np.zeros_like(mask)
+    expected[np.arange(6), np.arange(6)] = 1
+    assert np.array_equal(ld.largest_component(mask), expected)
+    assert not ld.largest_component(np.zeros_like(mask)).any()
+
+
+# ---------------------------------------------------------------------------------
+# vertex v with four neighbors, each edge bends at a random pixel so the ring pixels differ from the far ends
+def random_star(rng, v=(50, 50)):
+    graph = ld.DocumentGraph()
+    for _ in range(4):
+        bend = tuple(int(x) for x in v + rng.integers(-15, 16, 2))
+        w = tuple(int(x) for x in bend + rng.integers(-30, 31, 2))
+        if bend == v or w == bend or w == v or w in graph.neighbors(v):
+            continue
+        graph[(v, w)] = ld.concatenate_paths(line(v, bend), line(bend, w))
+    return graph, v
+
+
+def test_edge_scores_match_product_minimum():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        graph, v = random_star(rng)
+        for u in graph.neighbors(v):
+            for max_dist in [None, 7]:
+                t_scores = dict()
+                ld.calculate_edge_scores(u, v, graph, t_scores, set(), max_dist=max_dist)
+                for (_, _, w1, w2), scores in t_scores.items():
+                    # the score of each bridge as the minimum over all 4 x 4 x 4 angle combinations
+                    ends = [(x, x if max_dist is None else graph.direction(v, x, max_dist)) for x in [u, w1, w2]]
+                    uv_vw1 = [ld.calculate_abs_angle(a, v, b) for a in ends[0] for b in ends[1]]
+                    uv_vw2 = [ld.calculate_abs_angle(a, v, b) for a in ends[0] for b in ends[2]]
+                    w1v_vw2 = [ld.calculate_abs_angle(a, v, b) for a in ends[1] for b in ends[2]]
+                    expected = [
+                        min(abs(np.pi - c) + abs(np.pi / 2 - a) + abs(np.pi / 2 - b)
+                            for a in uv_vw1 for b in uv_vw2 for c in w1v_vw2),
+                        min(abs(np.pi - a) + abs(np.pi / 2 - b) + abs(np.pi / 2 - c)
+                            for a in uv_vw1 for b in uv_vw2 for c in w1v_vw2),
+                        min(abs(np.pi - b) + abs(np.pi / 2 - a) + abs(np.pi / 2 - c)
+                            for a in uv_vw1 for b in uv_vw2 for c in w1v_vw2)]
+                    assert np.allclose([score for _, _, score in scores], expected, rtol=0, atol=1e-12)
+
+
+# ---------------------------------------------------------------------------------
+# l score of a vertex without the angle cache, every (z1, w1, vertex, w2, z2) is scored on its own
+def uncached_l_score(graph, vertex, excluded, max_dist):
+    def neighbors(v, other):
+        return [w for w in graph.neighbors(v) if w != other and w not in excluded]
+
+    def angle(u, v, w):
+        return abs(np.pi - ld.calculate_abs_angle(graph.direction(v, u, max_dist), v, graph.direction(v, w, max_dist)))
+
+    l_scores = [angle(w1, vertex, w2) * 0.5 + angle(z1, w1, vertex) * 0.25 + angle(z2, w2, vertex) * 0.25
+                for w1, w2 in ld.it.combinations(neighbors(vertex, None), 2)
+                for z1 in neighbors(w1, vertex) for z2 in neighbors(w2, vertex)]
+    return min(l_scores) if l_scores else None
+
+
+def test_l_scores_match_uncached():
+    rng = np.random.default_rng(1)
+    for _ in range(10):
+        vertexes = list(set(tuple(int(x) for x in rng.integers(0, 100, 2)) for _ in range(25)))
+        graph = ld.DocumentGraph()
+        for _ in range(40):
+            u, w = (vertexes[i] for i in rng.choice(len(vertexes), 2, replace=False))
+            bend = tuple(int(x) for x in rng.integers(0, 100, 2))
+            if graph.key(u, w) is None and bend not in (u, w):
+                graph[(u, w)] = ld.concatenate_paths(line(u, bend), line(bend, w))
+        excluded = set(vertexes[:3])
+        l_scores = ld.calculate_junctions_l_scores(graph, graph.vertexes(), excluded)
+        expected = {v: uncached_l_score(graph, v, excluded, 7) for v in graph.vertexes() if v not in excluded}
+        assert l_scores == {v: score for v, score in expected.items() if score is not None}
+
+
+def test_cluster_1d_exact_matches_brute_force():
+    def cost(values, labels):
+        return sum(np.sum((values[labels == k] - values[labels == k].mean()) ** 2) for k in np.unique(labels))
+
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        values = rng.integers(0, 30, rng.integers(1, 12)).astype(np.float64)
+        n_clusters = int(rng.integers(1, 5))
+        labels = ld.cluster_1d_exact(values, n_clusters)
+        # clusters of an optimal 1-d partition are runs of the sorted unique values, every split into runs is tried
+        unique_values = np.unique(values)
+        n_runs = min(n_clusters, len(unique_values))
+        best = min(cost(values, np.searchsorted(unique_values[list(cuts)], values, side='right'))
+                   for cuts in ld.it.combinations(range(1, len(unique_values)), n_runs - 1))
+        assert len(np.unique(labels)) == n_runs
+        assert np.all(np.diff(labels[np.argsort(values, kind='stable')]) >= 0)
+        assert np.isclose(cost(values, labels), best, rtol=1e-9, atol=1e-9)
+
+
+def test_connect_disconnected_edges_joins_collinear_fragments():
+    # p - q and r - s lie on one row with a 30 pixel gap between q and r
+    p, q, r, s = (10, 10), (10, 40), (10, 70), (10, 100)
+    graph = ld.DocumentGraph()
+    graph[(p, q)] = line(p, q)
+    graph[(r, s)] = line(r, s)
+    connected = ld.connect_disconnected_edges(graph)
+    assert len(connected) == 3 and connected.key(q, r) is not None
+    assert pixel_set(connected) == set(map(tuple, line(p, s).tolist()))
+
+
+def test_connect_disconnected_edges_keeps_existing_edge():
+    # q and r are already joined by a curved edge, the straight gap line does not replace it
+    p, q, r, s = (10, 10), (10, 40), (10, 70), (10, 100)
+    curve = ld.concatenate_paths(line(q, (20, 55)), line((20, 55), r))
+    graph = ld.DocumentGraph()
+    graph[(p, q)] = line(p, q)
+    graph[(q, r)] = curve
+    graph[(r, s)] = line(r, s)
+    connected = ld.connect_disconnected_edges(graph)
+    assert sorted(connected.keys()) == [(p, q), (q, r), (r, s)]
+    assert np.array_equal(connected[(q, r)], curve)
@@ -0,0 +1,64 @@
+import math
+import types
+
+import numpy as np
+
+from scipy import optimize
+
+import multithresholding as mt
+
+
+THRESHOLDS = [0.01 * t for t in range(-5, 6)]
+
+
+# ---------------------------------------------------------------------------------
+# row histogram of touching lines around the rows in centers
+def touching_lines(rng, centers, length):
+    x_s = np.arange(length)
+    hist = sum(mt.gauss(x_s, mu, 5 + rng.random() * 3, 20 + rng.random() * 10) for mu in centers)
+    return np.round(hist + rng.random(length) * 2)
+
+
+# ---------------------------------------------------------------------------------
+# the fit of one (n, thresh) cell of the grid, as get_n_cut_valleys(hist, n, thresh) did it
+def cell_fit(hist, n, thresh):
+    piece = math.floor(len(hist) / n)
+    overlap = np.int32(thresh * piece)
+    y_n = [hist[0: piece + overlap]] + [hist[i_dx * piece - overlap: (i_dx + 1) * piece + overlap]
+                                        for i_dx in range(1, n - 1)] + [hist[(n - 1) * piece - overlap:]]
+    try:
+        params_n = np.asarray([optimize.curve_fit(mt.gauss, np.arange(len(y_i)), y_i, method='trf')[0]
+                               for y_i in y_n])
+    except (RuntimeError, ValueError):
+        return np.full((n, 3), np.nan), np.full(n, np.inf)
+    params_n[:, 0] += np.arange(n) * math.floor((len(hist) + 1) / n)
+    mu_n, sigma_n, A_n = params_n.T
+    good_n = np.abs(mt.gauss_mass(mu_n, sigma_n, A_n, 0, len(hist)) - mt.gauss_mass(mu_n, sigma_n, A_n, -np.inf, np.inf))
+    return params_n, good_n
+
+
+def test_full_sweep_matches_grid():
+    rng = np.random.default_rng(0)
+    for _ in range(2):
+        hist = touching_lines(rng, [15, 45, 75], 90)
+        results = mt.sweep_n_cut_valleys(hist, range(2, 6), THRESHOLDS, patience=None)
+        for n in range(2, 6):
+            cells = [cell_fit(hist, n, thresh) for thresh in THRESHOLDS]
+            # best gaussian of each position over the thresholds, the first threshold of the smallest error
+            best = np.argmin([good_n for _, good_n in cells], axis=0)
+            params_n, good_n = results[n]
+            assert np.array_equal(good_n, [cells[k][1][t] for t, k in enumerate(best)])
+            assert np.array_equal(params_n, [cells[k][0][t] for t, k in enumerate(best)], equal_nan=True)
+
+
+def test_sweep_keeps_going_until_a_fit_works(monkeypatch):
+    # windows shorter than 53 rows do not fit, n = 2 on 100 rows only fits from an overlap of 3
+    def curve_fit(f, x_data, y_data, **kwargs):
+        if len(x_data) < 53:
+            raise RuntimeError('no fit')
+        return optimize.curve_fit(f, x_data, y_data, **kwargs)
+
+    monkeypatch.setattr(mt, 'optimize', types.SimpleNamespace(curve_fit=curve_fit))
+    hist = touching_lines(np.random.default_rng(1), [25, 75], 100)
+    params_n, good_n = mt.sweep_n_cut_valleys(hist, [2], [0.01 * t for t in range(-8, 9)], patience=2)[2]
+    assert np.all(np.isfinite(good_n))